@@ -32,6 +32,7 @@ setup(
         "Click",
         "entrypoints",
         "flake8",
+        "pytest",
         "yapf",
         "pylint",
         "paramiko",
@@ -53,10 +54,15 @@ setup(
         "imbalanced-learn",
         "numpy",
         "pandas>=1",
+        "pyarrow",
         "seaborn",
         # Dev
         # TODO Make dev install profile
     ],
+    extras_require={
+        # Artifact store compression
+        "compression": ["zstandard", "lz4"],
+    },
     dependency_links=[],
     entry_points=dict(console_scripts=[f"{PROJECT_NAME}=src.cli:cli"]),
 )
@@ -2,7 +2,6 @@ import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 import os
-from sqlalchemy import create_engine
 
 logger = logging.getLogger(__name__)
 datetime_is_numeric = True
@@ -19,4 +18,11 @@ for f in files:
 
     load_dotenv(f)
 
-# DB_ENGINE = create_engine(os.getenv("DB_URL"), pool_pre_ping=True)
+
+def __getattr__(name):
+    # DB_ENGINE is created on first use (see src.db) so importing src does
+    # not import sqlalchemy or connect to the database
+    if name == "DB_ENGINE":
+        from src.db import get_engine
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,364 @@
+"""Content-addressed store for pickled artifacts (models, frames, results).
+
+Objects are pickled with protocol 5. Large NumPy/pandas buffers are written
+out-of-band to their own files so they can be memory-mapped on load instead
+of copied. Entries are keyed by a hash of their content or of the parameters
+that produced them, written atomically, optionally compressed with zstd or
+lz4, and evicted least-recently-used first when the store exceeds its size
+cap.
+
+The default store lives in the ARTIFACT_STORE directory with an optional
+ARTIFACT_MAX_BYTES size cap.
+
+memoize_stage caches Data pipeline stages (e.g. _build_data) in a store.
+"""
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import mmap
+import os
+import pickle
+import shutil
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = (None, "zstd", "lz4")
+
+
+def fingerprint(obj: Any) -> str:
+    """Stable hash of (nested) parameters, arrays and DataFrames
+
+    Args:
+        obj (Any): Object to hash
+
+    Returns:
+        str: Hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    _update_fingerprint(h, obj)
+    return h.hexdigest()
+
+
+def _update_fingerprint(h, obj: Any) -> None:
+    h.update(type(obj).__qualname__.encode())
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        _update_pandas_fingerprint(h, obj)
+    elif isinstance(obj, np.ndarray):
+        _update_array_fingerprint(h, obj)
+    elif isinstance(obj, dict):
+        for k in sorted(obj, key=repr):
+            _update_fingerprint(h, k)
+            _update_fingerprint(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _update_fingerprint(h, item)
+    elif isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        h.update(repr(obj).encode())
+    else:
+        try:
+            h.update(pickle.dumps(obj, protocol=5))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            h.update(repr(obj).encode())
+
+
+def _update_array_fingerprint(h, obj: np.ndarray) -> None:
+    h.update(repr((obj.dtype, obj.shape)).encode())
+    if obj.dtype.hasobject:
+        # References have no stable bytes; hash the pickled values
+        h.update(pickle.dumps(obj, protocol=5))
+    else:
+        h.update(np.ascontiguousarray(obj).view(np.uint8))
+
+
+def _update_pandas_fingerprint(h, obj) -> None:
+    h.update(repr(obj.shape).encode())
+    if isinstance(obj, pd.DataFrame):
+        h.update(repr(list(obj.columns)).encode())
+        h.update(repr(obj.dtypes.tolist()).encode())
+    else:
+        h.update(repr((obj.name, obj.dtype)).encode())
+    try:
+        h.update(pd.util.hash_pandas_object(obj, index=True).to_numpy())
+    except TypeError:
+        # Unhashable values (e.g. lists in an object column)
+        h.update(pickle.dumps(obj, protocol=5))
+
+
+def _compressor(compression: str):
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError(
+                "zstd compression requires `pip install zstandard`")
+        return (zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress)
+    if compression == "lz4":
+        try:
+            import lz4.frame
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError(
+                "lz4 compression requires `pip install lz4`")
+        return lz4.frame.compress, lz4.frame.decompress
+    if compression is None:
+        return None, None
+    raise ValueError(
+        f"Unknown compression {compression!r}. Choose from {COMPRESSIONS}")
+
+
+class ArtifactStore:
+    """Directory of pickled artifacts keyed by content or parameter hash
+
+    Args:
+        root (Path, optional): Store directory. Defaults to ARTIFACT_STORE
+            or PROCESSED_DATA/artifacts.
+        compression (str, optional): None, "zstd" or "lz4". Compressed
+            entries are decompressed into memory instead of memory-mapped.
+            Defaults to None.
+        max_bytes (int, optional): Size cap. The least recently used entries
+            are evicted when it is exceeded. Defaults to ARTIFACT_MAX_BYTES
+            or None (no cap).
+    """
+    def __init__(self,
+                 root: Path = None,
+                 compression: str = None,
+                 max_bytes: int = None):
+        if root is None:
+            root = os.getenv("ARTIFACT_STORE") or Path(
+                os.getenv("PROCESSED_DATA", "."), "artifacts")
+        if max_bytes is None and os.getenv("ARTIFACT_MAX_BYTES"):
+            max_bytes = int(os.getenv("ARTIFACT_MAX_BYTES"))
+        _compressor(compression)
+        self.root = Path(root)
+        self.compression = compression
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return (f"ArtifactStore({self.root}, compression={self.compression}, "
+                f"max_bytes={self.max_bytes})")
+
+    def __contains__(self, key: str) -> bool:
+        return Path(self.root, key, "meta.json").exists()
+
+    @staticmethod
+    def key(*args: Any, **kwargs: Any) -> str:
+        """Key for an artifact identified by the parameters that produce it"""
+        return fingerprint((args, kwargs))
+
+    def put(self, obj: Any, key: str = None) -> str:
+        """Stores an object
+
+        Args:
+            obj (Any): Picklable object
+            key (str, optional): Key, e.g. from ArtifactStore.key. Defaults
+                to None (hash of the pickled content).
+
+        Returns:
+            str: Key of the stored object
+        """
+        buffers = []
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+        if key is None:
+            h = hashlib.blake2b(data, digest_size=16)
+            for raw in raws:
+                h.update(raw)
+            key = h.hexdigest()
+            if key in self:
+                logger.debug(f"{key} already stored")
+                self._touch(key)
+                return key
+        compress, _ = _compressor(self.compression)
+        path = Path(self.root, key)
+        tmp = Path(self.root, f".{key}.{os.getpid()}.tmp")
+        tmp.mkdir(parents=True, exist_ok=True)
+        try:
+            files = [("data.pkl", data)]
+            files += [(f"buffer-{i:04d}.bin", raw)
+                      for i, raw in enumerate(raws)]
+            for name, payload in files:
+                with open(Path(tmp, name), "wb") as f:
+                    f.write(compress(payload) if compress else payload)
+            meta = {
+                "compression": self.compression,
+                "buffers": len(raws),
+                "type": type(obj).__qualname__,
+            }
+            with open(Path(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            self._replace(tmp, path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        logger.info(f"Stored {meta['type']} as {key}")
+        self.evict(keep=key)
+        return key
+
+    def get(self, key: str, mmap_buffers: bool = True) -> Any:
+        """Loads an object
+
+        Args:
+            key (str): Key of the stored object
+            mmap_buffers (bool, optional): Memory-map uncompressed
+                out-of-band buffers (copy-on-write) instead of reading them.
+                Defaults to True.
+
+        Raises:
+            KeyError: Key is not in the store
+
+        Returns:
+            Any: Stored object
+        """
+        if key not in self:
+            raise KeyError(key)
+        path = Path(self.root, key)
+        with open(Path(path, "meta.json")) as f:
+            meta = json.load(f)
+        _, decompress = _compressor(meta["compression"])
+        with open(Path(path, "data.pkl"), "rb") as f:
+            data = f.read()
+        if decompress:
+            data = decompress(data)
+        buffers = []
+        for i in range(meta["buffers"]):
+            p = Path(path, f"buffer-{i:04d}.bin")
+            if decompress:
+                buffers.append(bytearray(decompress(p.read_bytes())))
+            elif mmap_buffers and p.stat().st_size:
+                with open(p, "rb") as f:
+                    buffers.append(
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+            else:
+                buffers.append(bytearray(p.read_bytes()))
+        self._touch(key)
+        logger.info(f"Loaded {meta['type']} from {key}")
+        return pickle.loads(data, buffers=buffers)
+
+    def delete(self, key: str) -> None:
+        shutil.rmtree(Path(self.root, key), ignore_errors=True)
+
+    def entries(self) -> list:
+        """(key, bytes, last used time) for every entry, oldest first"""
+        entries = []
+        if not self.root.exists():
+            return entries
+        for path in self.root.iterdir():
+            if path.name.startswith(".") or not path.is_dir():
+                continue
+            try:
+                size = sum(p.stat().st_size for p in path.iterdir())
+                entries.append((path.name, size, path.stat().st_mtime))
+            except FileNotFoundError:
+                # Deleted by another process
+                continue
+        return sorted(entries, key=lambda e: e[2])
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: str = None) -> list:
+        """Deletes least recently used entries until under max_bytes
+
+        Args:
+            keep (str, optional): Key that is never evicted, e.g. the entry
+                just stored. Defaults to None.
+
+        Returns:
+            list: Evicted keys
+        """
+        if self.max_bytes is None:
+            return []
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.delete(key)
+            total -= size
+            evicted.append(key)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} artifacts")
+        if total > self.max_bytes:
+            logger.warning(f"{keep} alone exceeds ARTIFACT_MAX_BYTES "
+                           f"({self.max_bytes} bytes)")
+        return evicted
+
+    def _touch(self, key: str) -> None:
+        try:
+            os.utime(Path(self.root, key))
+        except FileNotFoundError:
+            pass
+
+    def _replace(self, tmp: Path, path: Path) -> None:
+        # Directories cannot be atomically replaced when the target exists,
+        # so move the old entry aside first
+        if path.exists():
+            old = path.with_name(f".{path.name}.{os.getpid()}.old")
+            os.replace(path, old)
+            os.replace(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.replace(tmp, path)
+
+
+def memoize_stage(inputs: tuple = (), store: ArtifactStore = None):
+    """Caches a pipeline stage method on disk
+
+    The cache key combines the method's source code, its arguments and the
+    listed attributes of ``self`` (e.g. the input tables), so a stage reruns
+    only when one of them changes. Helper functions called by the stage are
+    not part of the key. Results are kept in an ArtifactStore whose size cap
+    evicts old results. Set MEMOIZE_STAGES=0 to bypass the cache.
+
+    Example:
+        class YourData(Data):
+            @memoize_stage(inputs=("tables",))
+            def _build_data(self, **kwargs):
+                ...
+
+    Args:
+        inputs (tuple, optional): Names of attributes of self that the stage
+            reads. Defaults to ().
+        store (ArtifactStore, optional): Store for results. Defaults to None
+            (ArtifactStore() created when the stage first runs).
+
+    Returns:
+        Callable: Decorator
+    """
+    def decorator(func):
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            source = func.__code__.co_code
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if os.getenv("MEMOIZE_STAGES", "1") == "0":
+                return func(self, *args, **kwargs)
+            cache = store if store is not None else ArtifactStore()
+            state = {attr: getattr(self, attr) for attr in inputs}
+            key = fingerprint((name, source, state, args, kwargs))
+            if key in cache:
+                try:
+                    logger.info(f"Using memoized {name}")
+                    return cache.get(key)
+                except (EOFError, OSError, pickle.UnpicklingError) as e:
+                    logger.warning(f"Could not load memoized {name}: {e}")
+            result = func(self, *args, **kwargs)
+            cache.put(result, key=key)
+            return result
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
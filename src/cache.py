@@ -0,0 +1,720 @@
+"""On-disk caches for processed data tables.
+
+A cache backend stores one file per table under ``PROCESSED_DATA``. Columnar
+backends (parquet, feather) can read back a subset of columns without
+deserializing the whole frame. The npy backend memory-maps numeric columns
+so processes reading the same table share one copy of it.
+
+The default backend is read from the ``CACHE_BACKEND`` environment variable
+and falls back to pickle, which stores any column faithfully. The Arrow
+backends reject mixed-type object columns and change dict values (e.g. json
+columns), so choose them for tables of plain columns.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from itertools import chain
+from pathlib import Path
+from typing import Any, Iterable
+
+import numpy as np
+import pandas as pd
+
+from src.qc import hash_rows
+
+logger = logging.getLogger(__name__)
+
+
+class TableCache:
+    """Base class for table cache backends.
+
+    Subclasses set ``suffix`` and implement ``_read``, ``_write`` and
+    ``_columns``.
+    """
+    suffix = ""
+
+    def __init__(self, root: Path = None):
+        if root is None:
+            root = os.getenv("PROCESSED_DATA")
+        self.root = Path(root)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.root})"
+
+    @property
+    def manifest(self) -> "CacheManifest":
+        if getattr(self, "_manifest", None) is None:
+            self._manifest = CacheManifest(Path(self.root, "manifest.json"))
+        return self._manifest
+
+    def path(self, table: str) -> Path:
+        return Path(self.root, table + self.suffix)
+
+    def exists(self, table: str) -> bool:
+        return self.path(table).exists()
+
+    def key_index_path(self, table: str, subset: list) -> Path:
+        """Path of the KeyIndex for a table's key columns
+
+        Named after the cache file, so backends sharing a root keep
+        separate indexes.
+        """
+        return Path(self.root,
+                    f"{table}{self.suffix}.{'-'.join(subset)}.keys.npz")
+
+    def read(self, table: str, columns: list = None) -> pd.DataFrame:
+        """Reads a cached table
+
+        Args:
+            table (str): Name of table
+            columns (list, optional): Columns to load. Defaults to None (all).
+
+        Raises:
+            KeyError: A requested column is not in the cached table
+
+        Returns:
+            pd.DataFrame: Cached table
+        """
+        p = self.path(table)
+        if columns is not None:
+            names = self._columns(p)
+            missing = [c for c in columns if names and c not in names]
+            if missing:
+                raise KeyError(missing)
+        logger.debug(f"Reading {p} columns={columns}")
+        return self._read(p, columns)
+
+    def write(self, table: str, df: pd.DataFrame) -> Path:
+        """Writes a table to the cache, replacing any existing file atomically
+
+        Args:
+            table (str): Name of table
+            df (pd.DataFrame): Table to cache
+
+        Returns:
+            Path: Path of cached file
+        """
+        p = self.path(table)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(f".{p.name}.{os.getpid()}.tmp")
+        logger.debug(f"Writing {p}")
+        try:
+            self._write(tmp, df)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        self._replace(tmp, p)
+        return p
+
+    def write_chunks(self, table: str, chunks: Iterable[pd.DataFrame]) -> int:
+        """Streams DataFrame chunks into the cache
+
+        Only one chunk is held in memory at a time by backends that support
+        appending (parquet, feather). Chunks must share column names and
+        dtypes.
+
+        Args:
+            table (str): Name of table
+            chunks (Iterable[pd.DataFrame]): DataFrame chunks
+
+        Returns:
+            int: Number of rows written
+        """
+        p = self.path(table)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(f".{p.name}.{os.getpid()}.tmp")
+        logger.debug(f"Streaming chunks to {p}")
+        try:
+            n_rows = self._write_chunks(tmp, chunks)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        self._replace(tmp, p)
+        logger.debug(f"Wrote {n_rows} rows to {p}")
+        return n_rows
+
+    def append_chunks(self, table: str, chunks: Iterable[pd.DataFrame]) -> int:
+        """Appends DataFrame chunks to a cached table
+
+        Args:
+            table (str): Name of table
+            chunks (Iterable[pd.DataFrame]): New rows
+
+        Returns:
+            int: Number of rows in the merged table
+        """
+        return self.write_chunks(table, chain([self.read(table)], chunks))
+
+    def _write_chunks(self, p: Path, chunks: Iterable[pd.DataFrame]) -> int:
+        # Fallback for backends that cannot append: collect then write once
+        chunks = list(chunks)
+        if not chunks:
+            # Empty source table
+            chunks = [pd.DataFrame()]
+        df = pd.concat(chunks, ignore_index=True)
+        # concat drops category dtypes when chunk categories differ
+        categoricals = chunks[0].select_dtypes("category")
+        df = df.astype({col: "category" for col in categoricals})
+        self._write(p, df)
+        return len(df)
+
+    def _replace(self, tmp: Path, p: Path) -> None:
+        os.replace(tmp, p)
+
+    def _discard(self, tmp: Path) -> None:
+        tmp.unlink(missing_ok=True)
+
+    def _read(self, p: Path, columns: list) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def _write(self, p: Path, df: pd.DataFrame) -> None:
+        raise NotImplementedError
+
+    def _columns(self, p: Path) -> list:
+        """Column names stored in ``p`` or None if unknown without reading"""
+        raise NotImplementedError
+
+
+class ArrowChunkWriter:
+    """Mixin for arrow based backends that can append record batches.
+
+    Dictionary (category) columns are written with int32 indices so chunks
+    with different numbers of categories share one schema. Each chunk's
+    categories are extended to those of all previous chunks, so category
+    order (and ordered comparisons) match the first chunk.
+    """
+    def _open_writer(self, p: Path, schema):
+        raise NotImplementedError
+
+    def _chunk_schema(self, schema):
+        return _widen_dictionaries(schema)
+
+    def _write_chunks(self, p, chunks):
+        import pyarrow as pa
+
+        writer = None
+        schema = None
+        pending = []
+        categories = {}
+        n_rows = 0
+        try:
+            for chunk in chunks:
+                chunk = _extend_categories(chunk, categories)
+                pending.append(pa.Table.from_pandas(chunk,
+                                                    preserve_index=False))
+                n_rows += len(chunk)
+                if writer is None:
+                    schema = _unify_chunk_schemas(pending)
+                    if _has_null_fields(schema):
+                        # A column that is all NULL so far has no type yet.
+                        # Hold chunks until every column has one.
+                        continue
+                    schema = self._chunk_schema(schema)
+                    writer = self._open_writer(p, schema)
+                for t in pending:
+                    writer.write_table(t.cast(schema))
+                pending = []
+            if pending:
+                # Columns that are NULL in every row stay untyped
+                schema = self._chunk_schema(_unify_chunk_schemas(pending))
+                writer = self._open_writer(p, schema)
+                for t in pending:
+                    writer.write_table(t.cast(schema))
+            if writer is None:
+                # Empty source table
+                self._write(p, pd.DataFrame())
+        finally:
+            if writer is not None:
+                self._close_writer(writer, categories)
+        return n_rows
+
+    def _close_writer(self, writer, categories: dict) -> None:
+        writer.close()
+
+
+def _extend_categories(chunk: pd.DataFrame,
+                       categories: dict) -> pd.DataFrame:
+    """Recodes category columns to the categories of all chunks so far
+
+    Categories not seen before are appended, so a chunk's dictionary always
+    extends the previous one (an IPC dictionary delta).
+
+    Args:
+        chunk (pd.DataFrame): Chunk
+        categories (dict): {column: CategoricalDtype so far}, updated in
+            place
+
+    Returns:
+        pd.DataFrame: Chunk with extended categories
+    """
+    for col in chunk.select_dtypes("category"):
+        new = chunk[col].cat.categories
+        seen = categories.setdefault(col, chunk[col].dtype)
+        if new.equals(seen.categories):
+            continue
+        categories[col] = pd.CategoricalDtype(
+            seen.categories.append(new[~new.isin(seen.categories)]),
+            seen.ordered)
+        chunk = chunk.copy(deep=False)
+        chunk[col] = chunk[col].cat.set_categories(
+            categories[col].categories)
+    return chunk
+
+
+def _unify_chunk_schemas(tables: list):
+    """Schema all chunks can be cast to, e.g. null to string"""
+    import pyarrow as pa
+
+    return pa.unify_schemas([t.schema for t in tables],
+                            promote_options="permissive")
+
+
+def _has_null_fields(schema) -> bool:
+    import pyarrow as pa
+
+    return any(pa.types.is_null(f.type) for f in schema)
+
+
+def _widen_dictionaries(schema):
+    import pyarrow as pa
+
+    fields = []
+    for f in schema:
+        if pa.types.is_dictionary(f.type):
+            f = f.with_type(
+                pa.dictionary(pa.int32(), f.type.value_type, f.type.ordered))
+        fields.append(f)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+class PickleCache(TableCache):
+    """Default backend. Stores any column but deserializes the whole frame"""
+    suffix = ".pkl"
+
+    def _read(self, p, columns):
+        df = pd.read_pickle(p)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def _write(self, p, df):
+        df.to_pickle(p)
+
+    def _columns(self, p):
+        # Column names are only known after unpickling; df[columns] in _read
+        # raises KeyError for missing columns instead
+        return None
+
+
+class ParquetCache(ArrowChunkWriter, TableCache):
+    """Columnar backend using parquet. Reads only the requested columns."""
+    suffix = ".parquet"
+
+    def _read(self, p, columns):
+        import pyarrow.parquet as pq
+
+        df = pd.read_parquet(p, columns=columns)
+        metadata = pq.read_metadata(p).metadata or {}
+        numeric = json.loads(metadata.get(b"numeric_categoricals", b"{}"))
+        for col, spec in numeric.items():
+            if col in df:
+                df[col] = df[col].astype(_categorical_dtype(spec))
+        return df
+
+    def _write(self, p, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        t = pa.Table.from_pandas(df)
+        dtypes = {col: df[col].dtype for col in df.select_dtypes("category")}
+        metadata = {
+            **(t.schema.metadata or {}), b"numeric_categoricals":
+            _numeric_categoricals(dtypes)
+        }
+        pq.write_table(t.replace_schema_metadata(metadata), p)
+
+    def _open_writer(self, p, schema):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(p, schema)
+
+    def _close_writer(self, writer, categories):
+        # Categories may grow with every chunk, so record them at the end
+        writer.add_key_value_metadata(
+            {b"numeric_categoricals": _numeric_categoricals(categories)})
+        writer.close()
+
+    def _columns(self, p):
+        import pyarrow.parquet as pq
+        return pq.read_schema(p).names
+
+
+def _numeric_categoricals(dtypes: dict) -> bytes:
+    """JSON of the category dtypes parquet reads back as plain numbers
+
+    Parquet only restores dictionaries of strings, so category columns with
+    numeric categories are recorded in the file metadata.
+
+    Args:
+        dtypes (dict): {column: CategoricalDtype}
+
+    Returns:
+        bytes: {column: {"categories", "dtype", "ordered"}} as JSON
+    """
+    numeric = {
+        col: {
+            "categories": dtype.categories.tolist(),
+            "dtype": str(dtype.categories.dtype),
+            "ordered": bool(dtype.ordered),
+        }
+        for col, dtype in dtypes.items()
+        if dtype.categories.dtype.kind in "iuf"
+    }
+    return json.dumps(numeric).encode()
+
+
+def _categorical_dtype(spec: dict) -> pd.CategoricalDtype:
+    return pd.CategoricalDtype(
+        pd.Index(spec["categories"], dtype=spec["dtype"]), spec["ordered"])
+
+
+class FeatherCache(ArrowChunkWriter, TableCache):
+    """Columnar backend using the Arrow IPC (feather v2) format."""
+    suffix = ".feather"
+
+    def _read(self, p, columns):
+        return pd.read_feather(p, columns=columns)
+
+    def _write(self, p, df):
+        df.reset_index(drop=True).to_feather(p)
+
+    def _open_writer(self, p, schema):
+        import pyarrow.ipc as ipc
+
+        # IPC files cannot replace a dictionary, but chunks only ever add
+        # categories (see _extend_categories), which is written as a delta
+        options = ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+        return ipc.new_file(p, schema, options=options)
+
+    def _columns(self, p):
+        import pyarrow.ipc as ipc
+        return ipc.open_file(p).schema.names
+
+
+class NpyCache(TableCache):
+    """Column files opened with memory mapping, for sharing across processes.
+
+    Each table is a directory of one .npy file per numeric, boolean or
+    datetime column and one file of int codes per category column, with
+    the categories in meta.json. Other columns (strings, nullable and
+    timezone-aware dtypes) go to a parquet sidecar and are read normally.
+
+    Mapped columns are loaded with ``mmap_mode="c"`` and wrapped without
+    copying, so processes reading the same table share its pages in the OS
+    page cache. Writes to a loaded frame go to private pages, never the
+    file. The table path is a symlink to the current directory and is
+    swapped atomically on write.
+    """
+    suffix = ".npy"
+
+    def _read(self, p, columns):
+        meta = json.loads(Path(p, "meta.json").read_text())
+        specs = meta["columns"]
+        if columns is not None:
+            specs = sorted((c for c in specs if c["name"] in columns),
+                           key=lambda c: columns.index(c["name"]))
+        sidecar = [c["name"] for c in specs if c["kind"] == "other"]
+        other = {}
+        if sidecar:
+            other = pd.read_parquet(Path(p, "other.parquet"), columns=sidecar)
+        data = {}
+        for c in specs:
+            if c["kind"] == "other":
+                data[c["name"]] = other[c["name"]]
+                continue
+            # A plain ndarray view; the memmap stays open as its base
+            values = np.load(Path(p, c["file"]),
+                             mmap_mode="c").view(np.ndarray)
+            if c["kind"] == "category":
+                values = pd.Categorical.from_codes(
+                    values,
+                    dtype=pd.CategoricalDtype(
+                        pd.Index(c["categories"],
+                                 dtype=c["categories_dtype"]), c["ordered"]),
+                    validate=False)
+            data[c["name"]] = values
+        return pd.DataFrame(data, index=pd.RangeIndex(meta["rows"]),
+                            copy=False)
+
+    def _write(self, p, df):
+        df = df.reset_index(drop=True)
+        p.mkdir(parents=True)
+        specs = []
+        other = []
+        for i, (name, s) in enumerate(df.items()):
+            spec = {"name": name, "kind": _npy_kind(s), "file": f"{i}.npy"}
+            if spec["kind"] == "category":
+                spec["categories"] = s.cat.categories.tolist()
+                spec["categories_dtype"] = str(s.cat.categories.dtype)
+                spec["ordered"] = bool(s.cat.ordered)
+                np.save(Path(p, spec["file"]), s.array.codes)
+            elif spec["kind"] == "numpy":
+                np.save(Path(p, spec["file"]), s.to_numpy())
+            else:
+                del spec["file"]
+                other.append(name)
+            specs.append(spec)
+        if other:
+            df[other].to_parquet(Path(p, "other.parquet"))
+        meta = {"rows": len(df), "columns": specs}
+        Path(p, "meta.json").write_text(json.dumps(meta))
+
+    def _columns(self, p):
+        meta = json.loads(Path(p, "meta.json").read_text())
+        return [c["name"] for c in meta["columns"]]
+
+    def _replace(self, tmp, p):
+        # Readers that already mapped the old files keep them until they
+        # close; unlinking does not invalidate their pages
+        version = p.with_name(f".{p.name}.{uuid.uuid4().hex[:8]}")
+        os.replace(tmp, version)
+        link = p.with_name(f".{p.name}.{os.getpid()}.link")
+        link.unlink(missing_ok=True)
+        os.symlink(version.name, link)
+        old = Path(os.path.realpath(p)) if p.is_symlink() else None
+        if p.is_dir() and old is None:
+            shutil.rmtree(p)
+        os.replace(link, p)
+        if old is not None and old.exists():
+            shutil.rmtree(old)
+
+    def _discard(self, tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _npy_kind(s: pd.Series) -> str:
+    """How NpyCache stores a column: numpy, category or other"""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # Categories are kept in JSON, so only strings and numbers
+        categories = s.cat.categories
+        if (categories.inferred_type == "string") | \
+                (categories.dtype.kind in "iuf"):
+            return "category"
+        return "other"
+    if isinstance(s.dtype, np.dtype) and s.dtype.kind in "biufmM":
+        return "numpy"
+    return "other"
+
+
+class CacheManifest:
+    """Freshness metadata for cached tables, stored as JSON.
+
+    Each entry is keyed by cache file name and records the hash of the table
+    spec, a fingerprint of the source table (e.g. row count and max
+    timestamp) and the write time. A cached table is fresh when both the
+    spec hash and the source fingerprint match the current values.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, name: str) -> dict:
+        with self._lock:
+            return self._load().get(name)
+
+    def update(self, name: str, **entry: Any) -> dict:
+        """Records metadata for a cache file
+
+        Args:
+            name (str): Cache file name
+            **entry: JSON serializable metadata
+
+        Returns:
+            dict: Updated entry
+        """
+        entry = _jsonable(entry)
+        entry["written_at"] = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            manifest = self._load()
+            manifest[name] = {**manifest.get(name, {}), **entry}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        return manifest[name]
+
+    def is_fresh(self, name: str, spec_hash: str, source: dict = None) -> bool:
+        """Checks a cache file against the current spec and source fingerprint
+
+        Args:
+            name (str): Cache file name
+            spec_hash (str): Hash of the current table spec
+            source (dict, optional): Current source fingerprint. None when
+                the source could not be queried, in which case only the spec
+                is compared.
+
+        Returns:
+            bool: True if the cached file can be used
+        """
+        entry = self.get(name)
+        if entry is None:
+            logger.debug(f"{name} has no manifest entry")
+            return False
+        if entry.get("spec_hash") != spec_hash:
+            logger.debug(f"{name} spec changed")
+            return False
+        if source is not None and entry.get("source") != _jsonable(source):
+            logger.debug(f"{name} source changed: {entry.get('source')} -> "
+                         f"{_jsonable(source)}")
+            return False
+        return True
+
+
+def spec_hash(*spec: Any) -> str:
+    """Stable hash of a table spec (any JSON-like objects)
+
+    Returns:
+        str: Hex digest
+    """
+    payload = json.dumps(spec, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _jsonable(obj: Any) -> Any:
+    return json.loads(json.dumps(obj, sort_keys=True, default=str))
+
+
+class KeyIndex:
+    """Sorted index of 64-bit key hashes with a count per key
+
+    Used to check a table for duplicate keys (e.g. person_id) and to look
+    keys up without rescanning the table. Updating with new rows only hashes
+    those rows.
+
+    Args:
+        subset (list): Key columns
+    """
+    def __init__(self, subset: list):
+        self.subset = list(subset)
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return (f"KeyIndex(subset={self.subset}, keys={len(self)}, "
+                f"duplicates={self.duplicates})")
+
+    @property
+    def rows(self) -> int:
+        return int(self.counts.sum())
+
+    @property
+    def duplicates(self) -> int:
+        """Rows whose key was already seen"""
+        return self.rows - len(self.keys)
+
+    def update(self, df: pd.DataFrame) -> "KeyIndex":
+        """Adds the keys of new rows
+
+        Args:
+            df (pd.DataFrame): New rows
+
+        Returns:
+            KeyIndex: self
+        """
+        keys, counts = np.unique(hash_rows(df, self.subset),
+                                 return_counts=True)
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        np.add.at(self.counts, pos[found], counts[found])
+        new = ~found
+        self.keys = np.insert(self.keys, pos[new], keys[new])
+        self.counts = np.insert(self.counts, pos[new], counts[new])
+        return self
+
+    def count(self, df: pd.DataFrame) -> np.ndarray:
+        """Number of indexed rows sharing each row's key"""
+        hashes = hash_rows(df, self.subset)
+        pos = np.searchsorted(self.keys, hashes)
+        pos[pos == len(self.keys)] = 0
+        counts = np.zeros(len(hashes), dtype=np.int64)
+        if len(self.keys):
+            hit = self.keys[pos] == hashes
+            counts[hit] = self.counts[pos[hit]]
+        return counts
+
+    def contains(self, df: pd.DataFrame) -> np.ndarray:
+        """Whether each row's key is in the index"""
+        return self.count(df) > 0
+
+    def save(self, path: Path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(tmp,
+                 keys=self.keys,
+                 counts=self.counts,
+                 subset=np.array(self.subset))
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path: Path) -> "KeyIndex":
+        with np.load(path) as f:
+            index = cls([str(c) for c in f["subset"]])
+            index.keys = f["keys"]
+            index.counts = f["counts"]
+        return index
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, subset: list) -> "KeyIndex":
+        return cls(subset).update(df)
+
+
+CACHE_BACKENDS = {
+    "pickle": PickleCache,
+    "parquet": ParquetCache,
+    "feather": FeatherCache,
+    "npy": NpyCache,
+}
+
+
+def get_table_cache(backend: str = None, root: Path = None) -> TableCache:
+    """Returns a table cache for a named backend
+
+    Args:
+        backend (str, optional): Key of CACHE_BACKENDS. Defaults to the
+            CACHE_BACKEND environment variable or "pickle".
+        root (Path, optional): Cache directory. Defaults to PROCESSED_DATA.
+
+    Raises:
+        ValueError: Unknown backend
+
+    Returns:
+        TableCache: Cache backend instance
+    """
+    if isinstance(backend, TableCache):
+        return backend
+    if backend is None:
+        backend = os.getenv("CACHE_BACKEND", "pickle")
+    try:
+        cls = CACHE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown cache backend {backend!r}. "
+                         f"Choose from {list(CACHE_BACKENDS)}")
+    return cls(root=root)
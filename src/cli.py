@@ -1,24 +1,65 @@
+import importlib
 import logging
 
 import click
-from IPython import get_ipython
 
-from src.data import build_project_command
-from src.loggers import setup_logging
-from src.utils import convert_py_to_html_command
+from src.loggers import ipython_shell, setup_logging
 
-if get_ipython():
+if ipython_shell():
     logger = setup_logging("DEBUG")
 else:
     logger = logging.getLogger(__name__)
 
 
-@click.group()
+class LazyGroup(click.Group):
+    """Group that imports a sub-command's module only when it runs
+
+    Args:
+        lazy_subcommands (dict): {name: ("module:command", short help)}. The
+            short help is shown by --help without importing the module.
+    """
+    def __init__(self, *args, lazy_subcommands: dict = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(super().list_commands(ctx) + list(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.lazy_subcommands:
+            return super().get_command(ctx, cmd_name)
+        import_path, _ = self.lazy_subcommands[cmd_name]
+        module_name, command_name = import_path.split(":")
+        command = getattr(importlib.import_module(module_name), command_name)
+        if not isinstance(command, click.Command):
+            raise ValueError(f"{import_path} is not a click command")
+        return command
+
+    def format_commands(self, ctx, formatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.lazy_subcommands:
+                rows.append((name, self.lazy_subcommands[name][1]))
+                continue
+            command = self.get_command(ctx, name)
+            if command is not None and not command.hidden:
+                rows.append((name, command.get_short_help_str()))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup,
+             lazy_subcommands={
+                 "build-project": ("src.data:build_project_command",
+                                   "Build the project's Data object"),
+                 "convert-to-html":
+                 ("src.utils:convert_py_to_html_command",
+                  "Execute .py notebooks and export them to html"),
+                 "import-time": ("src.startup:import_time_command",
+                                 "Check import time against a budget"),
+             })
 @click.option("--debug", "-d", count=True, help="-d for INFO, -dd for DEBUG")
 @click.pass_context
 def cli(ctx, debug):
     setup_logging(debug)
-
-
-cli.add_command(build_project_command)
-cli.add_command(convert_py_to_html_command)
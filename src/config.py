@@ -1,6 +1,6 @@
 import logging
-
-import pandas as pd
+import os
+from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +23,17 @@ noisyLibs = [
     "urllib3.connectionpool",
 ]
 
-# Configure pandas
-try:
+
+def configure_pandas() -> None:
+    """Sets pandas display options
+
+    Called by the modules that display frames, so importing src.config does
+    not import pandas.
+    """
+    try:
+        import pandas as pd
+    except ModuleNotFoundError:
+        return
     logger.info("Setting pandas display options")
     pd.options.display.width = 20
     pd.options.display.max_rows = 100
@@ -32,5 +41,3 @@ try:
     pd.options.display.max_columns = 20
     pd.options.display.max_colwidth = 200
     pd.options.display.float_format = '{:.5f}'.format
-except ModuleNotFoundError:
-    pass
@@ -29,33 +29,403 @@ Todo:
    http://google.github.io/styleguide/pyguide.html
 
 """
+import functools
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 
 import click
 import numpy as np
 import pandas as pd
-from IPython.display import display
+import sqlalchemy as sa
 from pandas.core.frame import DataFrame
-from traitlets.traitlets import Bool
 
-from src import DB_ENGINE
+from src.artifacts import memoize_stage
+from src.cache import KeyIndex, TableCache, get_table_cache, spec_hash
+from src.config import configure_pandas
+from src.db import get_engine, pool_capacity, stream_connection
+from src.extract import read_query
 from src.loggers import logging
+from src.qc import QualityReport
+from src.sql import Select, build_select
 from src.utils import quality_control
 
 logger = logging.getLogger(__name__)
+configure_pandas()
 
+# Marks a lazily built Data stage that has not been computed yet
+_NOT_BUILT = object()
 
-def display_quality_control(show: bool, df: pd.DataFrame, subset: list = None):
+
+def display_quality_control(show: bool,
+                            df: pd.DataFrame,
+                            subset: list = None) -> QualityReport:
     if show is True:
         try:
-            quality_control(df, subset)
+            return quality_control(df, subset)
         except AttributeError as e:
             print(e)
 
 
+def recode_categorical(s: pd.Series,
+                       unknowns: Any = None,
+                       others: Any = None,
+                       recodes: dict = None) -> pd.Series:
+    """Recodes a categorical Series in one pass over its integer codes
+
+    Missing values become ``unknowns``, then categories are renamed with
+    ``recodes`` (several old categories may map to one new category and a
+    category mapped to None becomes missing). The mapping is built once on
+    the categories, then applied to the codes with a NumPy lookup array, so
+    the values are never decategorized. Unused categories are dropped.
+
+    Args:
+        s (pd.Series): Series of category dtype (other dtypes are converted)
+        unknowns (Any, optional): Category for missing values.
+            Defaults to None (leave missing).
+        others (Any, optional): Extra category that recodes may map to.
+            Defaults to None.
+        recodes (dict, optional): {<old_category>: <new_category>}.
+            Defaults to None.
+
+    Returns:
+        pd.Series: Recoded Series of category dtype
+    """
+    return recode_categoricals(s.to_frame(name=0), [0],
+                               unknowns=unknowns,
+                               others=others,
+                               recodes=recodes)[0].rename(s.name)
+
+
+def recode_categoricals(df: pd.DataFrame,
+                        columns: list,
+                        unknowns: Any = None,
+                        others: Any = None,
+                        recodes: dict = None) -> pd.DataFrame:
+    """Recodes several categorical columns that share one mapping
+
+    Columns with the same categories are recoded together: the lookup is
+    built once and applied to their stacked codes in a single gather. See
+    recode_categorical for the mapping. Each column keeps only the categories
+    it uses.
+
+    Args:
+        df (pd.DataFrame): DataFrame
+        columns (list): Columns to recode (other dtypes are converted to
+            category)
+        unknowns (Any, optional): Category for missing values.
+            Defaults to None (leave missing).
+        others (Any, optional): Extra category that recodes may map to.
+            Defaults to None.
+        recodes (dict, optional): {<old_category>: <new_category>}.
+            Defaults to None.
+
+    Returns:
+        pd.DataFrame: df with the columns recoded
+    """
+    groups = []
+    for col in columns:
+        s = df[col]
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype("category")
+        for dtype, group in groups:
+            if dtype == s.dtype:
+                group.append(s)
+                break
+        else:
+            groups.append((s.dtype, [s]))
+    recoded = {}
+    for dtype, group in groups:
+        recoded.update(
+            _recode_codes(group, dtype, unknowns, others, recodes or {}))
+    df = df.copy(deep=False)
+    for col, s in recoded.items():
+        df[col] = s
+    return df
+
+
+def _is_null(value: Any) -> bool:
+    return pd.api.types.is_scalar(value) and bool(pd.isna(value))
+
+
+def _recode_codes(group: list, dtype: pd.CategoricalDtype, unknowns: Any,
+                  others: Any, recodes: dict) -> dict:
+    old = dtype.categories
+    labels = [recodes.get(c, c) for c in old]
+    # Missing values are filled with unknowns before recoding, so unknowns
+    # is recoded too. A recode to None or NaN makes values missing.
+    extras = [recodes.get(c, c) for c in (unknowns, others) if c is not None]
+    unknowns = extras[0] if unknowns is not None else None
+    categories = pd.Index(
+        pd.unique(
+            pd.Index([c for c in labels + extras if not _is_null(c)],
+                     dtype=object)))
+    width = len(categories) + 1
+    # lookup[old code] -> new code. The last slot is read for code -1
+    lookup = np.empty(len(old) + 1, dtype=np.intp)
+    lookup[:-1] = [
+        -1 if _is_null(c) else categories.get_loc(c) for c in labels
+    ]
+    lookup[-1] = (-1 if _is_null(unknowns) else categories.get_loc(unknowns))
+    # One gather for every column, then count each column's new codes in a
+    # single bincount by offsetting column j by j * width
+    codes = lookup[np.column_stack([s.cat.codes.to_numpy() for s in group])]
+    offsets = np.arange(len(group)) * width
+    used = np.bincount((codes + 1 + offsets).ravel(),
+                       minlength=len(group) * width).reshape(-1, width)
+    used = used[:, 1:] > 0
+    # compact[j, new code] -> code among the categories column j uses; the
+    # last slot is read for code -1
+    compact = np.full((len(group), width), -1, dtype=np.intp)
+    compact[:, :-1][used] = (np.cumsum(used, axis=1) - 1)[used]
+    codes = compact[np.arange(len(group)), codes]
+    return {
+        s.name: pd.Series(pd.Categorical.from_codes(
+            codes[:, j],
+            categories=pd.Index(list(categories[used[j]])),
+            ordered=dtype.ordered),
+                          index=s.index,
+                          name=s.name)
+        for j, s in enumerate(group)
+    }
+
+
+def optimize_dtypes(df: pd.DataFrame,
+                    skip: list = None,
+                    category_threshold: float = 0.5,
+                    string_storage: str = None) -> pd.DataFrame:
+    """Shrinks DataFrame dtypes without losing information
+
+    Integers are downcast to the smallest type that holds their range,
+    floats to float32 only when every value round-trips exactly, and
+    string columns with few distinct values become categories.
+
+    Args:
+        df (pd.DataFrame): DataFrame to shrink
+        skip (list, optional): Columns to leave unchanged. Defaults to None.
+        category_threshold (float, optional): Max ratio of distinct values
+            to rows for a string column to become a category.
+            Defaults to 0.5.
+        string_storage (str, optional): Convert the remaining string columns
+            to pd.StringDtype with this storage ("python" or "pyarrow").
+            Defaults to None (leave them unchanged).
+
+    Returns:
+        pd.DataFrame: DataFrame with smaller dtypes
+    """
+    skip = set(skip or [])
+    optimized = {}
+    for col in df:
+        s = df[col]
+        if col in skip or pd.api.types.is_bool_dtype(s) or \
+                isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(s):
+            optimized[col] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s):
+            optimized[col] = _downcast_float(s)
+        elif pd.api.types.infer_dtype(s, skipna=True) == "string":
+            # Only all-string columns: object columns may hold mixed values
+            # or unhashable ones (e.g. json lists and dicts)
+            if len(s) and s.nunique() / len(s) <= category_threshold:
+                optimized[col] = s.astype("category")
+            elif string_storage is not None:
+                optimized[col] = s.astype(pd.StringDtype(string_storage))
+    for col, s in optimized.items():
+        if s.dtype != df[col].dtype:
+            logger.debug(f"{col}: {df[col].dtype} -> {s.dtype}")
+            df[col] = s
+    return df
+
+
+def _downcast_float(s: pd.Series) -> pd.Series:
+    # float32 only when every value round-trips exactly
+    small = s.astype("float32")
+    if np.array_equal(small.to_numpy(dtype="float64"),
+                      s.to_numpy(dtype="float64"),
+                      equal_nan=True):
+        return small
+    return s
+
+
+class AgeBins:
+    """Precompiled age bins
+
+    Equivalent to ``pd.cut(values, bins, labels=labels, right=right)`` for a
+    list of bin edges, but the edges and category dtype are built once and
+    values are binned with ``np.searchsorted`` into int8 codes.
+
+    Args:
+        bins (list): Monotonically increasing bin edges
+        labels (list, optional): Bin labels. Defaults to None (intervals).
+        right (bool, optional): Bins include their right edge.
+            Defaults to True.
+    """
+    def __init__(self, bins: list, labels: list = None, right: bool = True):
+        self.edges = np.asarray(bins, dtype=float)
+        if labels is None:
+            labels = pd.IntervalIndex.from_breaks(
+                bins, closed="right" if right else "left")
+        self.dtype = pd.CategoricalDtype(labels, ordered=True)
+        self.right = right
+        self._code_dtype = np.int8 if len(labels) < 128 else np.int16
+
+    def codes(self, values: pd.Series) -> np.ndarray:
+        """Bins values into integer codes (-1 for missing or out of range)"""
+        if isinstance(values, pd.Series):
+            values = values.to_numpy(dtype=float, na_value=np.nan)
+        values = np.asarray(values, dtype=float)
+        side = "left" if self.right else "right"
+        codes = np.searchsorted(self.edges, values, side=side) - 1
+        codes[(codes >= len(self.edges) - 1) | np.isnan(values)] = -1
+        return codes.astype(self._code_dtype)
+
+    def cut(self, values: pd.Series) -> pd.Categorical:
+        """Bins values into a Categorical sharing this spec's dtype"""
+        return pd.Categorical.from_codes(self.codes(values), dtype=self.dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_age_bins(bins: tuple, labels: tuple, right: bool) -> AgeBins:
+    return AgeBins(list(bins), None if labels is None else list(labels),
+                   right)
+
+
+def compile_age_bins(bins: list,
+                     labels: list = None,
+                     right: bool = True) -> AgeBins:
+    """Returns a cached AgeBins for a bins/labels spec
+
+    Args:
+        bins (list): Monotonically increasing bin edges
+        labels (list, optional): Bin labels. Defaults to None (intervals).
+        right (bool, optional): Bins include their right edge.
+            Defaults to True.
+
+    Returns:
+        AgeBins: Compiled bins
+    """
+    return _compile_age_bins(tuple(bins),
+                             None if labels is None else tuple(labels), right)
+
+
+def _bin_ages(values: pd.Series, spec: dict) -> Any:
+    bins, labels = spec.get("age_bins"), spec.get("age_labels")
+    if pd.api.types.is_integer(bins):
+        # A number of bins has edges that depend on the values, so it cannot
+        # be compiled
+        binned = pd.cut(values, bins=bins, labels=labels)
+        if spec.get("codes") is True:
+            return binned.cat.codes.to_numpy()
+        return binned
+    bins = compile_age_bins(bins, labels)
+    if spec.get("codes") is True:
+        return bins.codes(values)
+    return bins.cut(values)
+
+
+def iter_melt_wide(df: pd.DataFrame,
+                   id_vars: list,
+                   value_vars: list = None,
+                   var_name: str = "variable",
+                   value_name: str = "value",
+                   group_size: int = 1) -> Iterator[pd.DataFrame]:
+    """Reshapes wide data to long format in groups of value columns
+
+    Like ``pd.melt`` but id columns are repeated as categorical codes (or
+    integers) rather than as full values, and the variable column is a
+    categorical over ``value_vars``. Each yielded frame covers
+    ``group_size`` value columns, so long data can be processed without
+    materializing all of it.
+
+    Args:
+        df (pd.DataFrame): Wide DataFrame
+        id_vars (list): Columns repeated for every value column
+        value_vars (list, optional): Columns to unpivot. Defaults to None
+            (all columns not in id_vars).
+        var_name (str, optional): Name of variable column.
+            Defaults to "variable".
+        value_name (str, optional): Name of value column. Defaults to "value".
+        group_size (int, optional): Value columns per yielded frame.
+            Defaults to 1.
+
+    Yields:
+        pd.DataFrame: Long format rows for a group of value columns
+    """
+    if value_vars is None:
+        value_vars = [c for c in df if c not in id_vars]
+    # Encode id columns once. Numeric and categorical columns are already
+    # compact, anything else is factorized to a categorical.
+    ids = {}
+    for col in id_vars:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            ids[col] = (s.cat.codes.to_numpy(), s.dtype)
+        elif pd.api.types.is_numeric_dtype(s) or \
+                pd.api.types.is_datetime64_any_dtype(s):
+            ids[col] = (s.to_numpy(), None)
+        else:
+            codes, uniques = pd.factorize(s)
+            ids[col] = (codes, pd.CategoricalDtype(uniques))
+    var_dtype = pd.CategoricalDtype(value_vars)
+    n = len(df)
+    for i in range(0, len(value_vars), group_size):
+        group = value_vars[i:i + group_size]
+        k = len(group)
+        long = {}
+        for col, (values, dtype) in ids.items():
+            if dtype is None:
+                long[col] = np.tile(values, k)
+            else:
+                long[col] = pd.Categorical.from_codes(np.tile(values, k),
+                                                      dtype=dtype)
+        var_codes = np.repeat(np.arange(i, i + k), n)
+        long[var_name] = pd.Categorical.from_codes(var_codes, dtype=var_dtype)
+        # Single copy of the value arrays, keeping extension/category dtypes
+        long[value_name] = pd.concat([df[c] for c in group],
+                                     ignore_index=True).array
+        yield pd.DataFrame(long, copy=False)
+
+
+def melt_wide(df: pd.DataFrame,
+              id_vars: list,
+              value_vars: list = None,
+              var_name: str = "variable",
+              value_name: str = "value") -> pd.DataFrame:
+    """Reshapes wide data to long format. See iter_melt_wide.
+
+    Args:
+        df (pd.DataFrame): Wide DataFrame
+        id_vars (list): Columns repeated for every value column
+        value_vars (list, optional): Columns to unpivot. Defaults to None
+            (all columns not in id_vars).
+        var_name (str, optional): Name of variable column.
+            Defaults to "variable".
+        value_name (str, optional): Name of value column. Defaults to "value".
+
+    Returns:
+        pd.DataFrame: Long format DataFrame
+    """
+    if value_vars is None:
+        value_vars = [c for c in df if c not in id_vars]
+    if len(value_vars) == 0:
+        # Nothing to unpivot, so no group is yielded
+        return df[list(id_vars)].iloc[:0].reset_index(drop=True).assign(
+            **{
+                var_name: pd.Categorical([], categories=[]),
+                value_name: pd.Series(dtype=object),
+            })
+    return next(
+        iter_melt_wide(df,
+                       id_vars,
+                       value_vars,
+                       var_name=var_name,
+                       value_name=value_name,
+                       group_size=len(value_vars)))
+
+
 def build_project():
     # stuff here
     pass
@@ -79,13 +449,64 @@ class Data:
                  cached: bool = False,
                  first_study_date: datetime = None,
                  last_study_date: datetime = None,
+                 cache_backend: str = None,
+                 chunksize: int = None,
+                 max_workers: int = None,
+                 incremental: bool = False,
+                 long_format: dict = None,
+                 downcast: bool = False,
+                 string_storage: str = None,
+                 engine: sa.engine.Engine = None,
+                 extract: str = None,
                  *args: Any,
                  **kwargs: Any) -> object:
         """
         Creates a Data object
 
         Args:
-
+            table_dicts (dict): Table specs in the form
+                {<table_name>: {
+                    "cols": {<database column>: <new column name>},
+                    "dtype": {<new column name>: <dtype>},
+                    "where": {<database column>: <value or list>},
+                    "recodes": {<new column name>: {<old>: <new>}},
+                    "date_col": <database date column>,
+                    "fingerprint_col": <database column>,
+                    "key": [<new column name>, ...],
+                    }
+                }
+                Only "cols" is required. Selection, renames, SQL-compatible
+                casts, filters and recodes are pushed down into the query.
+                Tables with a "key" get a KeyIndex (see key_indexes).
+            cache_backend (str or TableCache, optional): Backend used to cache
+                processed tables. One of src.cache.CACHE_BACKENDS. Defaults
+                to the CACHE_BACKEND environment variable or "pickle".
+            chunksize (int, optional): Stream database tables into the cache
+                in chunks of this many rows to bound peak memory. Defaults to
+                None (read each table in one query).
+            max_workers (int, optional): Number of tables fetched and cached
+                concurrently. Defaults to the TABLE_WORKERS environment
+                variable or 4. Keep at or below the engine's pool capacity
+                (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+            incremental (bool, optional): When a cached table with a
+                'date_col' in its spec is stale, fetch only rows newer than
+                its high-water mark and append them. Assumes rows are only
+                ever added with increasing dates. Defaults to False.
+            long_format (dict, optional): Keyword arguments for melt_wide
+                (id_vars, value_vars, var_name, value_name) used by the
+                default _melt_wide_data. Defaults to None (no long data).
+            downcast (bool, optional): Shrink loaded tables with
+                optimize_dtypes and log memory before and after. Columns with
+                a spec dtype are left alone. Defaults to False.
+            string_storage (str, optional): Storage for downcast string
+                columns, "python" or "pyarrow". Defaults to None (leave
+                high-cardinality strings as they are).
+            engine (Engine, optional): Database engine. Defaults to None
+                (src.db.get_engine(), created on first query).
+            extract (str, optional): "copy" to read PostgreSQL tables with
+                COPY (see src.extract), falling back to "sql" (pd.read_sql)
+                for other databases. Defaults to the DB_EXTRACT environment
+                variable or "sql".
         """
         logger.info(f"Instantiating {type(self)} object")
         # Non protected attributes for read/write data
@@ -98,73 +519,538 @@ class Data:
         self.cached = cached
         self.first_study_date = first_study_date
         self.last_study_date = last_study_date
-        # Protected attributes to store read-only data
-        self.tables = self._get_tables(
-            table_dicts=self.table_dicts,
-            cached=self.cached,
-        )
-        self._data = self._build_data(*args, **kwargs)
-        self._data = self._recode_categoricals(df=self._data,
-                                               categoricals=self.categoricals)
-        self._data = self._categorize_age(df=self._data, ages=self.ages)
-
-        display_quality_control(self.show_qc, self._data, subset=['person_id'])
-        self._long_data = self._melt_wide_data(self._data, *args, **kwargs)
+        self.cache: TableCache = get_table_cache(cache_backend)
+        self.chunksize = chunksize
+        if max_workers is None:
+            max_workers = int(os.getenv("TABLE_WORKERS", 4))
+        self.max_workers = max_workers
+        self.incremental = incremental
+        self.long_format = long_format
+        self.downcast = downcast
+        self.string_storage = string_storage
+        self._engine = engine
+        self.extract = extract or os.getenv("DB_EXTRACT", "sql")
+        self._table_workers = 1
+        self._pool_checked = False
+        self.cast_failures = {}
+        self.memory_report = {}
+        self.table_timings = {}
+        self.key_indexes = {}
+        self._pending_indexes = {}
+        self.qc_report = None
+        # Protected attributes to store read-only data. Each stage is built
+        # on first access, so constructing a Data object does no work.
+        self._args = args
+        self._kwargs = kwargs
+        self._tables = _NOT_BUILT
+        self._data = _NOT_BUILT
+        self._long_data = _NOT_BUILT
         logger.debug("__init__ complete")
 
+    @property
+    def engine(self) -> sa.engine.Engine:
+        """Database engine, the shared src.db engine unless one was given"""
+        if self._engine is None:
+            self._engine = get_engine()
+        return self._engine
+
     # Use @property on a method whose name is exactly the name of the
     # restricted attribute but return the internal attribute instead
+    @property
+    def tables(self):
+        if self._tables is _NOT_BUILT:
+            self._tables = self._get_tables(
+                table_dicts=self.table_dicts,
+                cached=self.cached,
+            )
+        return self._tables
+
     @property
     def data(self):
+        if self._data is _NOT_BUILT:
+            data = self._build_data(*self._args, **self._kwargs)
+            data = self._recode_categoricals(df=data,
+                                             categoricals=self.categoricals)
+            data = self._categorize_age(df=data, ages=self.ages)
+
+            self.qc_report = display_quality_control(self.show_qc,
+                                                     data,
+                                                     subset=['person_id'])
+            self._data = data
         return self._data
 
     @property
     def long_data(self):
+        if self._long_data is _NOT_BUILT:
+            self._long_data = self._melt_wide_data(self.data, *self._args,
+                                                   **self._kwargs)
         return self._long_data
 
+    def invalidate(self, stage: str = "tables") -> None:
+        """Drops a built stage and every stage built from it
+
+        The stages are rebuilt on next access.
+
+        Args:
+            stage (str, optional): One of "tables", "data" or "long_data".
+                Defaults to "tables" (rebuild everything).
+        """
+        stages = ["tables", "data", "long_data"]
+        for name in stages[stages.index(stage):]:
+            logger.debug(f"Invalidating {name}")
+            setattr(self, f"_{name}", _NOT_BUILT)
+
+    def publish(self,
+                tables: dict,
+                schema: str = None,
+                mode: str = "replace",
+                key: list = None,
+                **kwargs: Any) -> dict:
+        """Writes built stages back to the database with src.load.write_frame
+
+        Args:
+            tables (dict): {<stage>: <table name>}, stages being "data" or
+                "long_data", e.g. {"data": "cohort", "long_data":
+                "cohort_long"}
+            schema (str, optional): Results schema. Defaults to the
+                RESULTS_SCHEMA environment variable.
+            mode (str, optional): "replace", "append" or "upsert".
+                Defaults to "replace".
+            key (list, optional): Key columns for upsert, e.g.
+                ["person_id"]. Defaults to None.
+            **kwargs: Other write_frame arguments (method, batch_size)
+
+        Returns:
+            dict: {<table name>: rows written}
+        """
+        from src.load import write_frame
+
+        schema = schema or os.getenv("RESULTS_SCHEMA") or None
+        written = {}
+        for stage, table in tables.items():
+            df = getattr(self, stage)
+            if df is None:
+                logger.warning(f"No {stage} to publish to {table}")
+                continue
+            written[table] = write_frame(df,
+                                         table,
+                                         engine=self.engine,
+                                         schema=schema,
+                                         mode=mode,
+                                         key=key,
+                                         **kwargs)
+        return written
+
     def _get_tables(self, table_dicts: dict, cached: bool) -> pd.DataFrame:
 
         logger.info("Getting data tables")
 
         tables = {}
-        # Create dict of tables
-        for table, d in table_dicts.items():
-            p = Path(os.getenv("PROCESSED_DATA"), table + '.pkl')
-            if (cached is True) & (p.exists()):
-                logger.info(f"Using cached tables for {table}")
-                df = pd.read_pickle(p)
-            else:
-                logger.info(f"Using database table for {table}")
-                column_dict = d.get('cols')
-                logger.debug(f"column_dict: {column_dict}")
-                dtype = d.get('dtype')
-                logger.debug(f"dtype: {dtype}")
-                df = self._read_sql_table(
-                    table=table,
-                    column_dict=column_dict,
-                )
-                df = df.rename(column_dict, axis=1)
-                try:
-                    df = df.astype(dtype=dtype)
-                except (KeyError, TypeError):
-                    pass
-                df.to_pickle(p)
-            tables.update({table: df})
+        # Create dict of tables. Tables are independent so they are fetched
+        # and cached concurrently, each on its own pooled connection.
+        workers = max(1, min(self.max_workers, len(table_dicts)))
+        self._table_workers = workers
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                table: executor.submit(self._get_table, table, d, cached)
+                for table, d in table_dicts.items()
+            }
+            for table, future in futures.items():
+                tables.update({table: future.result()})
+        for table in tables:
+            logger.info(f"Loaded {table} in {self.table_timings[table]:.2f}s")
         return tables
 
+    def _get_table(self, table: str, d: dict, cached: bool) -> pd.DataFrame:
+        """Loads one table from the cache or database and records its timing
+
+        Args:
+            table (str): Name of table
+            d (dict): Table spec from table_dicts
+            cached (bool): Use the cached table if it exists
+
+        Returns:
+            pd.DataFrame: Table
+        """
+        start = time.perf_counter()
+        cache_name = self.cache.path(table).name
+        # Columns are left out so narrowing 'cols' still reads the cached
+        # table. The manifest records the cached columns instead.
+        spec = [self.schema, {k: v for k, v in d.items() if k != 'cols'}]
+        if d.get('date_col') is not None:
+            spec += [self.first_study_date, self.last_study_date]
+        table_hash = spec_hash(*spec)
+        source = None
+        df = None
+        fetched = False
+        if (cached is True) & (self.cache.exists(table)):
+            source = self._source_fingerprint(table, d)
+            df, fetched = self._get_cached_table(table, d, table_hash, source)
+        if df is None:
+            if source is None:
+                # Fingerprint before fetching so rows added mid-fetch make
+                # the cache stale on the next run
+                source = self._source_fingerprint(table, d)
+            logger.info(f"Using database table for {table}")
+            # Incremental caches are capped at the recorded high-water mark
+            # so rows added mid-fetch are appended on the next run
+            until = None
+            if self.incremental is True:
+                until = self._high_water(d, source)
+            df = self._fetch_table(table, d, until=until)
+            fetched = True
+        if fetched is True:
+            self.cache.manifest.update(cache_name,
+                                       spec_hash=table_hash,
+                                       cols=d.get('cols'),
+                                       source=source,
+                                       high_water=self._high_water(d, source))
+        if d.get('key') is not None:
+            self.key_indexes[table] = self._key_index(table, d['key'], df,
+                                                      fetched)
+        if self.downcast is True:
+            # The cache keeps spec dtypes so appended rows cannot overflow
+            # downcast columns
+            df = self._optimize_table(table, df, d.get('dtype'))
+        self.table_timings[table] = time.perf_counter() - start
+        return df
+
+    def _get_cached_table(self, table: str, d: dict, table_hash: str,
+                          source: dict) -> tuple:
+        """Reads a fresh cached table or appends new rows to a stale one
+
+        Args:
+            table (str): Name of table
+            d (dict): Table spec from table_dicts
+            table_hash (str): Hash of the table spec
+            source (dict): Fingerprint of the source table
+
+        Returns:
+            tuple: (table or None if it must be refetched, whether rows were
+                fetched)
+        """
+        cache_name = self.cache.path(table).name
+        entry = self.cache.manifest.get(cache_name) or {}
+        if self.cache.manifest.is_fresh(cache_name, table_hash, source):
+            if not self._cached_columns(entry, d):
+                logger.info(f"Cached {table} does not have the columns in "
+                            "its spec. Refetching")
+                return None, False
+            logger.info(f"Using cached tables for {table}")
+            # Columnar backends only load the requested columns
+            columns = None
+            if d.get('cols') is not None:
+                columns = list(d['cols'].values())
+            try:
+                return self.cache.read(table, columns=columns), False
+            except KeyError as e:
+                logger.info(f"Cached {table} is missing {e}. Refetching")
+                return None, False
+        if (self.incremental is True) & self._appendable(
+                d, entry, table_hash, source):
+            logger.info(f"Appending new rows to cached {table}")
+            after = pd.Timestamp(entry['high_water']).to_pydatetime()
+            df = self._fetch_table(table,
+                                   d,
+                                   after=after,
+                                   until=self._high_water(d, source))
+            return df, True
+        logger.info(f"Cached {table} is stale")
+        return None, False
+
+    def _fetch_table(self,
+                     table: str,
+                     d: dict,
+                     after: datetime = None,
+                     until: datetime = None) -> pd.DataFrame:
+        """Reads a table from the database and writes it to the cache
+
+        Args:
+            table (str): Name of table
+            d (dict): Table spec from table_dicts
+            after (datetime, optional): Only fetch rows with the spec's
+                'date_col' after this high-water mark and append them to the
+                cached table. Defaults to None (replace the cached table).
+            until (datetime, optional): Only fetch rows with 'date_col' up to
+                this value or NULL. Defaults to None.
+
+        Returns:
+            pd.DataFrame: Table
+        """
+        self._check_pool_capacity()
+        column_dict = d.get('cols')
+        logger.debug(f"column_dict: {column_dict}")
+        dtype = d.get('dtype')
+        logger.debug(f"dtype: {dtype}")
+        result = self._read_sql_table(
+            table=table,
+            column_dict=column_dict,
+            dtype=dtype,
+            chunksize=self.chunksize,
+            date_col=d.get('date_col'),
+            after=after,
+            until=until,
+            where=d.get('where'),
+            recodes=d.get('recodes'),
+        )
+        if after is not None:
+            if self.chunksize is None:
+                result = [result]
+            if d.get('key') is not None:
+                result = self._index_chunks(table, d['key'], result)
+            self.cache.append_chunks(table, result)
+        elif self.chunksize is None:
+            self.cache.write(table, result)
+            return result
+        else:
+            self.cache.write_chunks(table, result)
+        return self.cache.read(table)
+
+    def _check_pool_capacity(self) -> None:
+        # Checked on the first fetch rather than in _get_tables, so reading
+        # a fresh cache does not need a database. Concurrent first fetches
+        # may warn twice.
+        if self._pool_checked is True:
+            return
+        self._pool_checked = True
+        capacity = pool_capacity(self.engine)
+        if capacity is not None and self._table_workers > capacity:
+            logger.warning(f"{self._table_workers} table workers share "
+                           f"{capacity} pooled connections. Raise "
+                           "DB_POOL_SIZE")
+
+    def _key_index(self, table: str, key: list, df: pd.DataFrame,
+                   fetched: bool) -> KeyIndex:
+        """Loads or builds the persisted KeyIndex of a table
+
+        An index written by _fetch_table (or a previous run) is reused, so
+        incremental refreshes only hash the appended rows. An index that
+        does not count every row of the table (e.g. its .npz was missing or
+        stale when rows were appended) is rebuilt.
+        """
+        p = self.cache.key_index_path(table, key)
+        index = self._pending_indexes.pop(table, None)
+        if index is None and p.exists() and not fetched:
+            index = KeyIndex.load(p)
+        if index is not None and index.rows != len(df):
+            logger.info(f"{p.name} is out of date. Rebuilding")
+            index = None
+        if index is None:
+            index = KeyIndex.from_frame(df, key)
+        index.save(p)
+        if index.duplicates:
+            logger.info(f"{table} has {index.duplicates} duplicate rows "
+                        f"on {key}")
+        return index
+
+    def _index_chunks(self, table: str, key: list,
+                      chunks: Iterator[DataFrame]) -> Iterator[DataFrame]:
+        # Updates the table's KeyIndex with new rows as they stream by
+        p = self.cache.key_index_path(table, key)
+        index = KeyIndex.load(p) if p.exists() else KeyIndex(key)
+        for chunk in chunks:
+            index.update(chunk)
+            yield chunk
+        self._pending_indexes[table] = index
+
+    def _cached_columns(self, entry: dict, d: dict) -> bool:
+        """Whether the cached table holds the spec's columns
+
+        A spec may select fewer columns than were cached, but every column
+        it keeps must come from the same database column. Columns missing
+        from a cache written without a 'cols' spec are caught when reading.
+        """
+        cached, cols = entry.get('cols'), d.get('cols')
+        if cols is None:
+            return cached is None
+        if cached is None:
+            return True
+        return all(cached.get(k) == v for k, v in cols.items())
+
+    def _appendable(self, d: dict, entry: dict, table_hash: str,
+                    source: dict) -> bool:
+        """Whether a stale cached table can be refreshed by appending rows
+
+        Requires a date_col, an unchanged spec and columns, a recorded
+        high-water mark and a source that has not lost rows since the cache
+        was written.
+        """
+        if (d.get('date_col') is None) | (source is None):
+            return False
+        if entry.get('cols') != d.get('cols'):
+            return False
+        if (entry.get('high_water') is None) | \
+                (entry.get('spec_hash') != table_hash):
+            return False
+        old_rows = (entry.get('source') or {}).get('row_count', 0)
+        return source.get('row_count', 0) >= old_rows
+
+    def _high_water(self, d: dict, source: dict) -> Any:
+        date_col = d.get('date_col')
+        if (date_col is None) | (source is None):
+            return None
+        return source.get(f"max_{date_col}")
+
+    def _source_fingerprint(self, table: str, d: dict) -> dict:
+        """Queries a cheap fingerprint of a source table
+
+        The fingerprint is the row count plus the max of the spec's
+        'fingerprint_col' (e.g. an updated_at column), its 'date_col' or, on
+        PostgreSQL, the max xmin. A changed fingerprint marks the cached
+        table as stale.
+
+        Args:
+            table (str): Name of table in self.schema
+            d (dict): Table spec from table_dicts
+
+        Returns:
+            dict: Fingerprint or None if the source could not be queried
+        """
+        source_table = sa.table(table, schema=self.schema)
+        columns = [sa.func.count().label("row_count")]
+        fingerprint_col = d.get('fingerprint_col', d.get('date_col'))
+        if fingerprint_col is not None:
+            col_type = None
+            if fingerprint_col == d.get('date_col'):
+                col_type = sa.DateTime
+            max_col = sa.func.max(sa.column(fingerprint_col, col_type))
+            columns.append(max_col.label(f"max_{fingerprint_col}"))
+        try:
+            # ValueError: no engine given and DB_URL is not set
+            engine = self.engine
+            if (fingerprint_col is None) & \
+                    (engine.dialect.name == "postgresql"):
+                columns.append(
+                    sa.text("max(xmin::text::bigint) AS max_xmin"))
+            with engine.connect() as con:
+                row = con.execute(sa.select(*columns).select_from(
+                    source_table)).mappings().one()
+        except (sa.exc.SQLAlchemyError, ValueError) as e:
+            logger.warning(f"Could not fingerprint {table}: {e}")
+            return None
+        logger.debug(f"{table} fingerprint: {dict(row)}")
+        return dict(row)
+
     def _build_data(self, *args, **kwargs) -> pd.DataFrame:
         logger.info('Building data')
         # Override in children to customize (most work done here)
         pass
 
-    def _read_sql_table(self, table: str, column_dict: dict) -> DataFrame:
+    def _read_sql_table(self,
+                        table: str,
+                        column_dict: dict,
+                        dtype: dict = None,
+                        chunksize: int = None,
+                        date_col: str = None,
+                        after: datetime = None,
+                        until: datetime = None,
+                        where: dict = None,
+                        recodes: dict = None) -> DataFrame:
+        """Reads a database table, renaming columns and casting dtypes
+
+        The spec is compiled into a single SELECT (see src.sql.build_select)
+        so column selection, renames, casts with a SQL equivalent, row filters
+        and recodes run in the database. Rows are limited to the study window
+        (first_study_date to last_study_date) when the table has a date_col.
+        Remaining dtypes (e.g. category) are applied in pandas.
+
+        Args:
+            table (str): Name of table in self.schema
+            column_dict (dict): {<database column>: <new column name>}
+            dtype (dict, optional): dtypes applied after renaming.
+                Defaults to None.
+            chunksize (int, optional): Rows per chunk. Defaults to None.
+            date_col (str, optional): Database date column used to filter
+                rows. Defaults to None.
+            after (datetime, optional): Only read rows with date_col after
+                this value. Defaults to None.
+            until (datetime, optional): Only read rows with date_col up to
+                this value or NULL. Defaults to None.
+            where (dict, optional): {<database column>: <value or list>} row
+                filters. Defaults to None.
+            recodes (dict, optional): {<new column name>: {<old>: <new>}}
+                value recodes. Defaults to None.
+
+        Returns:
+            DataFrame: Table, or an iterator of renamed and cast chunks if
+                chunksize is given
+        """
         logger.debug(f"Reading {self.schema}.{table}")
-        columns = [k for k, _ in column_dict.items()]
-        df = pd.read_sql_table(table_name=table,
-                               schema=self.schema,
-                               con=DB_ENGINE,
-                               columns=columns)
-        df = df.rename(column_dict, axis=1)
+        stmt = build_select(table,
+                            schema=self.schema,
+                            columns=column_dict,
+                            date_col=date_col,
+                            start=self.first_study_date,
+                            end=self.last_study_date,
+                            after=after,
+                            until=until,
+                            dtype=dtype,
+                            where=where,
+                            recodes=recodes)
+        if chunksize is not None:
+            return self._stream_sql_table(table, stmt, dtype, chunksize)
+        with self.engine.connect() as con:
+            df = read_query(stmt, con, method=self.extract)
+        return self._cast_table(df, dtype, table)
+
+    def _stream_sql_table(self, table: str, stmt: Select, dtype: dict,
+                          chunksize: int) -> Iterator[DataFrame]:
+        # Server side cursor so the driver does not buffer the whole result
+        with stream_connection(self.engine) as con:
+            for i, chunk in enumerate(
+                    read_query(stmt,
+                               con,
+                               chunksize=chunksize,
+                               method=self.extract)):
+                logger.debug(f"{table} chunk {i}: {len(chunk)} rows")
+                yield self._cast_table(chunk, dtype, table)
+
+    def _cast_table(self,
+                    df: pd.DataFrame,
+                    dtype: dict,
+                    table: str = None) -> pd.DataFrame:
+        """Casts columns to the spec dtypes, reporting each cast that fails
+
+        Failed casts leave the column unchanged, are logged as warnings and
+        are recorded in self.cast_failures.
+
+        Args:
+            df (pd.DataFrame): Table
+            dtype (dict): {<column>: <dtype>}
+            table (str, optional): Name of table for reporting.
+
+        Returns:
+            pd.DataFrame: Table with cast columns
+        """
+        if not dtype:
+            return df
+        casts = {}
+        for col, t in dtype.items():
+            if col not in df:
+                self._cast_failed(table, col, t, "column not in table")
+                continue
+            try:
+                casts[col] = df[col].astype(t)
+            except (ValueError, TypeError) as e:
+                self._cast_failed(table, col, t, e)
+        for col, s in casts.items():
+            df[col] = s
+        return df
+
+    def _cast_failed(self, table: str, col: str, t: Any, error: Any) -> None:
+        logger.warning(f"Could not cast {table}.{col} to {t}: {error}")
+        self.cast_failures.setdefault(table, {})[col] = f"{t}: {error}"
+
+    def _optimize_table(self, table: str, df: pd.DataFrame,
+                        dtype: dict) -> pd.DataFrame:
+        before = df.memory_usage(deep=True).sum()
+        df = optimize_dtypes(df,
+                             skip=list(dtype or {}),
+                             string_storage=self.string_storage)
+        after = df.memory_usage(deep=True).sum()
+        self.memory_report[table] = (before, after)
+        logger.info(f"{table} memory: {before / 1e6:.1f} MB -> "
+                    f"{after / 1e6:.1f} MB")
         return df
 
     def _recode_categoricals(self, df: pd.DataFrame,
@@ -188,56 +1074,74 @@ class Data:
         if categoricals is None:
             return df
         else:
+            # Columns sharing a mapping are recoded together
+            groups = []
             for col, cats in categoricals.items():
-                if col in list(df):
-                    logger.debug(f"Recoding {col}")
-                    logger.debug(f"Missing in {col}: {df[col].isna().sum()}")
-                    logger.debug(f"Code for {col}:\n{cats}")
-                    try:
-                        df[col] = df[col].cat.add_categories(
-                            [cats.get("unknowns")])
-                    except (ValueError):
-                        pass
-                    try:
-                        df[col] = df[col].cat.add_categories(
-                            [cats.get("others")])
-                    except (ValueError):
-                        pass
-                    df[col] = df[col].fillna(cats.get("unknowns"))
-                    df[col] = df[col].replace(
-                        cats.get("recodes")).astype("category")
-                    df[col] = df[col].cat.remove_unused_categories()
-                    logger.debug(f"Missing in {col}: {df[col].isna().sum()}")
-                    logger.debug(
-                        f"Categories in {col}: {list(df[col].cat.categories)}")
+                if col not in df.columns:
+                    continue
+                for spec, columns in groups:
+                    if spec == cats:
+                        columns.append(col)
+                        break
+                else:
+                    groups.append((cats, [col]))
+            for cats, columns in groups:
+                logger.debug(f"Recoding {columns}:\n{cats}")
+                df = recode_categoricals(df,
+                                         columns,
+                                         unknowns=cats.get("unknowns"),
+                                         others=cats.get("others"),
+                                         recodes=cats.get("recodes"))
+            if logger.isEnabledFor(logging.DEBUG):
+                for cats, columns in groups:
+                    for col in columns:
+                        logger.debug(f"Missing in {col}: "
+                                     f"{df[col].isna().sum()}")
+                        logger.debug(f"Categories in {col}: "
+                                     f"{list(df[col].cat.categories)}")
             return df
 
     def _categorize_age(self, df: pd.DataFrame, ages: dict) -> pd.DataFrame:
         """Bin age column into "age_group" column
 
+        Bins are compiled once per (bins, labels) spec and shared between
+        Data objects, so re-binning the same population is a searchsorted
+        over precomputed edges. Safe to call on chunks of a table, except
+        with a bin count, whose edges pd.cut spaces over the values given.
+
         Args:
             df (pd.DataFrame): DataFrame with col to recode
-            col (str): Name of age column
+            ages (dict or list): Dictionary in the form
+                                {"age_col": <age column>,
+                                 "age_bins": <bin edges or count>,
+                                 "age_labels": <bin labels>,
+                                 "output_col": <new column, "age_group">,
+                                 "codes": <True for int8 codes only>}
+                                or a list of them to bin several columns or
+                                schemes in one call.
 
         Returns:
             pd.DataFrame: DataFrame with age_group column
         """
-        age_col = ages.get('age_col')
-        age_bins = ages.get("age_bins")
-        age_labels = ages.get('age_labels')
-        if age_col is None:
-            return df
-        else:
-            logger.debug("Categorizing age into bins")
-            df["age_group"] = pd.cut(df[age_col],
-                                     bins=age_bins,
-                                     labels=age_labels)
+        if ages is None:
             return df
+        if isinstance(ages, dict):
+            ages = [ages]
+        for spec in ages:
+            age_col = spec.get('age_col')
+            if age_col is None:
+                continue
+            logger.debug(f"Categorizing {age_col} into bins")
+            output_col = spec.get('output_col', "age_group")
+            df[output_col] = _bin_ages(df[age_col], spec)
+        return df
 
     def _melt_wide_data(self, df, *args, **kwargs):
         logger.info('Restructuring to long format')
         # Override in children to customize transformation to long data
-        pass
+        if self.long_format is None:
+            return None
+        return melt_wide(df, **self.long_format)
 
 
 class YourData(Data):
@@ -245,6 +1149,7 @@ class YourData(Data):
     def __init__(self, *args: Any, **kwargs: Any) -> object:
         Data.__init__(self, *args, **kwargs)
 
+    @memoize_stage(inputs=("tables", "first_study_date", "last_study_date"))
     def _build_data(self, **kwargs) -> pd.DataFrame:
         logger.info('Building data')
         # Do stuff here
@@ -0,0 +1,212 @@
+"""Database engines created on first use and shared per URL.
+
+get_engine() builds a pooled SQLAlchemy engine from DB_URL the first time it
+is called and returns the same engine afterwards, so importing src does not
+connect or configure a pool. Pool settings come from the environment:
+
+    DB_POOL_SIZE            connections kept open (default 5)
+    DB_MAX_OVERFLOW         extra connections opened under load (default 10)
+    DB_POOL_TIMEOUT         seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE         seconds before a connection is replaced
+                            (default 1800)
+    DB_STATEMENT_TIMEOUT    milliseconds before the server cancels a
+                            statement (PostgreSQL only, default none)
+
+Every engine records checkout metrics per pooled connection (see
+pool_metrics).
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Iterator
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+_ENGINES = {}
+_LOCK = threading.Lock()
+_METRICS = weakref.WeakKeyDictionary()
+
+
+def _env_int(name: str, default: int = None) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def engine_options(url: str) -> dict:
+    """create_engine keyword arguments for a URL from the environment
+
+    Args:
+        url (str): Database URL
+
+    Returns:
+        dict: Keyword arguments
+    """
+    backend = sa.engine.make_url(url).get_backend_name()
+    options = {"pool_pre_ping": True}
+    if backend != "sqlite":
+        # SQLite's file lock makes a large pool pointless
+        options.update(
+            pool_size=_env_int("DB_POOL_SIZE", 5),
+            max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+            pool_timeout=_env_int("DB_POOL_TIMEOUT", 30),
+            pool_recycle=_env_int("DB_POOL_RECYCLE", 1800),
+        )
+    statement_timeout = _env_int("DB_STATEMENT_TIMEOUT")
+    if statement_timeout is not None:
+        if backend == "postgresql":
+            options["connect_args"] = {
+                "options": f"-c statement_timeout={statement_timeout}"
+            }
+        else:
+            logger.warning(f"DB_STATEMENT_TIMEOUT is ignored for {backend}")
+    return options
+
+
+def get_engine(url: str = None, **kwargs) -> Engine:
+    """Shared engine for a URL, created on first use
+
+    Args:
+        url (str, optional): Database URL. Defaults to DB_URL.
+        **kwargs: create_engine arguments that override engine_options.
+            Engines with different arguments are not shared.
+
+    Raises:
+        ValueError: No URL is given and DB_URL is not set
+
+    Returns:
+        Engine: Engine
+    """
+    url = url or os.getenv("DB_URL")
+    if not url:
+        raise ValueError("Set DB_URL in .env to connect to the database")
+    key = (url, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+    with _LOCK:
+        engine = _ENGINES.get(key)
+        if engine is None:
+            engine = sa.create_engine(url, **{**engine_options(url), **kwargs})
+            _METRICS[engine] = PoolMetrics().attach(engine)
+            _ENGINES[key] = engine
+            logger.info(f"Created engine for {engine.url!r}: "
+                        f"{engine.pool.status()}")
+    return engine
+
+
+def dispose_engines() -> None:
+    """Closes every pooled connection and forgets the shared engines
+
+    Call this in a child process before using a database after a fork.
+    """
+    with _LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+
+
+def pool_capacity(engine: Engine) -> int:
+    """Max simultaneous connections, or None if the pool has no limit"""
+    pool = engine.pool
+    if not isinstance(pool, sa.pool.QueuePool):
+        return None
+    return pool.size() + max(pool._max_overflow, 0)
+
+
+@contextmanager
+def stream_connection(engine: Engine = None,
+                      max_row_buffer: int = None) -> Iterator[Connection]:
+    """Connection whose results are read with a server-side cursor
+
+    The driver fetches rows in batches as they are consumed instead of
+    buffering the whole result, e.g. for pd.read_sql(..., chunksize=n).
+
+    Args:
+        engine (Engine, optional): Engine. Defaults to get_engine().
+        max_row_buffer (int, optional): Rows fetched per batch. Defaults to
+            None (the driver's default).
+
+    Yields:
+        Connection: Streaming connection
+    """
+    engine = engine if engine is not None else get_engine()
+    options = {"stream_results": True}
+    if max_row_buffer is not None:
+        options["max_row_buffer"] = max_row_buffer
+    with engine.connect() as con:
+        yield con.execution_options(**options)
+
+
+class PoolMetrics:
+    """Checkout counts and hold times per pooled connection
+
+    Attached to every engine made by get_engine. Read it with
+    pool_metrics(engine).snapshot().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self.connections = {}
+
+    def attach(self, engine: Engine) -> "PoolMetrics":
+        sa.event.listen(engine, "connect", self._connect)
+        sa.event.listen(engine, "checkout", self._checkout)
+        sa.event.listen(engine, "checkin", self._checkin)
+        sa.event.listen(engine, "close", self._close)
+        return self
+
+    def snapshot(self) -> dict:
+        """Metrics for every connection the pool has opened
+
+        Returns:
+            dict: {connection id: {"checkouts", "held_seconds",
+                "max_held_seconds", "checked_out", "open"}}
+        """
+        with self._lock:
+            return {i: dict(stats) for i, stats in self.connections.items()}
+
+    def _connect(self, dbapi_con, record) -> None:
+        connection_id = next(self._ids)
+        record.info["connection_id"] = connection_id
+        with self._lock:
+            self.connections[connection_id] = {
+                "checkouts": 0,
+                "held_seconds": 0.0,
+                "max_held_seconds": 0.0,
+                "checked_out": False,
+                "open": True,
+            }
+
+    def _checkout(self, dbapi_con, record, proxy) -> None:
+        record.info["checked_out_at"] = time.perf_counter()
+        with self._lock:
+            stats = self.connections.get(record.info.get("connection_id"))
+            if stats is not None:
+                stats["checkouts"] += 1
+                stats["checked_out"] = True
+
+    def _checkin(self, dbapi_con, record) -> None:
+        start = record.info.pop("checked_out_at", None)
+        with self._lock:
+            stats = self.connections.get(record.info.get("connection_id"))
+            if stats is None or start is None:
+                return
+            held = time.perf_counter() - start
+            stats["held_seconds"] += held
+            stats["max_held_seconds"] = max(stats["max_held_seconds"], held)
+            stats["checked_out"] = False
+
+    def _close(self, dbapi_con, record) -> None:
+        with self._lock:
+            stats = self.connections.get(record.info.get("connection_id"))
+            if stats is not None:
+                stats["open"] = False
+
+
+def pool_metrics(engine: Engine) -> PoolMetrics:
+    """PoolMetrics of an engine made by get_engine"""
+    return _METRICS[engine]
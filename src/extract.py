@@ -0,0 +1,211 @@
+"""Bulk extraction of query results with PostgreSQL COPY.
+
+pd.read_sql builds a Python object for every value it fetches. For
+PostgreSQL, copy_extract runs the query as ``COPY (SELECT ...) TO STDOUT``
+in CSV format, spools the output to a temporary file and parses it with
+pyarrow's multi-threaded CSV reader into columns typed from the query's
+result types. Other dialects use pd.read_sql.
+
+The extract only needs a DBAPI cursor with mogrify, execute, description
+and copy_expert (psycopg2's interface), so it can be exercised with a
+stand-in connection.
+"""
+import logging
+import tempfile
+from itertools import chain
+from typing import IO, Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger(__name__)
+
+COPY_DIALECTS = {"postgresql"}
+
+# PostgreSQL type OIDs with an exact Arrow equivalent. Other types (text,
+# numeric, json, ...) are read as strings or floats below.
+PG_TYPES = {
+    16: pa.bool_(),  # bool
+    20: pa.int64(),  # int8
+    21: pa.int16(),  # int2
+    23: pa.int32(),  # int4
+    700: pa.float32(),  # float4
+    701: pa.float64(),  # float8
+    1700: pa.float64(),  # numeric
+    1082: pa.date32(),  # date
+    1114: pa.timestamp("us"),  # timestamp
+    1184: pa.timestamp("us", "UTC"),  # timestamptz
+}
+
+
+def copy_sql(stmt: Select, con: Connection, cursor) -> str:
+    """Renders a SELECT with its parameters bound by the driver
+
+    Args:
+        stmt (Select): Query
+        con (Connection): Connection providing the dialect
+        cursor: DBAPI cursor with mogrify
+
+    Returns:
+        str: SQL with literal parameters
+    """
+    compiled = stmt.compile(dialect=con.dialect,
+                            compile_kwargs={"render_postcompile": True})
+    query = cursor.mogrify(str(compiled), compiled.params)
+    # psycopg2 returns bytes in the client encoding (UTF8 by default)
+    return query.decode() if isinstance(query, bytes) else query
+
+
+def result_types(cursor, query: str) -> dict:
+    """Arrow types of a query's result columns, from a zero-row execution
+
+    Args:
+        cursor: DBAPI cursor
+        query (str): SELECT with literal parameters
+
+    Returns:
+        dict: {column name: pyarrow type}
+    """
+    cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0")
+    return {d[0]: PG_TYPES.get(d[1], pa.string()) for d in cursor.description}
+
+
+def read_copy_csv(f: IO,
+                  column_types: dict = None,
+                  chunksize: int = None) -> pd.DataFrame:
+    """Parses COPY ... WITH (FORMAT csv, HEADER true) output
+
+    Unquoted empty fields are NULL and quoted ones are empty strings, as
+    written by PostgreSQL. With chunksize the header and first block are
+    parsed before returning, so a malformed file raises here rather than
+    on the first next().
+
+    Args:
+        f (IO): Binary file positioned at the header
+        column_types (dict, optional): {column: pyarrow type}. Defaults to
+            None (inferred).
+        chunksize (int, optional): Rows per frame. Defaults to None (one
+            frame).
+
+    Returns:
+        pd.DataFrame: Frame, or an iterator of frames if chunksize is given
+    """
+    convert = pacsv.ConvertOptions(column_types=column_types or {},
+                                   null_values=[""],
+                                   strings_can_be_null=True,
+                                   quoted_strings_can_be_null=False,
+                                   true_values=["t"],
+                                   false_values=["f"])
+    if chunksize is None:
+        table = pacsv.read_csv(f, convert_options=convert)
+        return table.to_pandas(date_as_object=False)
+    reader = pacsv.open_csv(f, convert_options=convert)
+    try:
+        first = [reader.read_next_batch()]
+    except StopIteration:
+        first = []
+    return _iter_copy_csv(reader, first, chunksize)
+
+
+def _iter_copy_csv(reader: pacsv.CSVStreamingReader, first: list,
+                   chunksize: int) -> Iterator[pd.DataFrame]:
+    pending = pa.Table.from_batches([], schema=reader.schema)
+    yielded = False
+    for batch in chain(first, reader):
+        pending = pa.concat_tables(
+            [pending, pa.Table.from_batches([batch])])
+        while pending.num_rows >= chunksize:
+            yield pending.slice(0, chunksize).to_pandas(date_as_object=False)
+            pending = pending.slice(chunksize)
+            yielded = True
+    if pending.num_rows or not yielded:
+        # An empty result still yields one (empty) frame, like pd.read_sql
+        yield pending.to_pandas(date_as_object=False)
+
+
+def copy_extract(stmt: Select,
+                 con: Connection,
+                 chunksize: int = None) -> pd.DataFrame:
+    """Reads a query with COPY ... TO STDOUT
+
+    The COPY finishes before parsing starts, so the connection is free again
+    as soon as this returns. Only the spooled CSV is on disk while chunks
+    are read.
+
+    Args:
+        stmt (Select): Query
+        con (Connection): PostgreSQL (psycopg2) connection
+        chunksize (int, optional): Rows per frame. Defaults to None (one
+            frame).
+
+    Raises:
+        ValueError: The dialect does not support COPY
+
+    Returns:
+        pd.DataFrame: Frame, or an iterator of frames if chunksize is given
+    """
+    if con.dialect.name not in COPY_DIALECTS:
+        raise ValueError(f"COPY is not supported by {con.dialect.name}")
+    f = tempfile.TemporaryFile()
+    try:
+        cursor = con.connection.cursor()
+        try:
+            query = copy_sql(stmt, con, cursor)
+            column_types = result_types(cursor, query)
+            cursor.copy_expert(
+                f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+        finally:
+            cursor.close()
+        logger.debug(f"Copied {f.tell() / 1e6:.1f} MB of CSV")
+        f.seek(0)
+        result = read_copy_csv(f, column_types, chunksize)
+    except Exception:
+        f.close()
+        raise
+    if chunksize is None:
+        f.close()
+        return result
+    return _closing(result, f)
+
+
+def _closing(chunks: Iterator[pd.DataFrame],
+             f: IO) -> Iterator[pd.DataFrame]:
+    try:
+        yield from chunks
+    finally:
+        f.close()
+
+
+def read_query(stmt: Select,
+               con: Connection,
+               chunksize: int = None,
+               method: str = "copy") -> pd.DataFrame:
+    """Reads a query with COPY where the dialect supports it
+
+    Falls back to pd.read_sql if the COPY fails or its CSV cannot be parsed
+    (e.g. infinite timestamps). With chunksize only the first block is
+    parsed up front; a value that fails to parse in a later block is raised
+    from the iterator, since rows have already been returned.
+
+    Args:
+        stmt (Select): Query
+        con (Connection): Connection. Chunked reads should use a streaming
+            connection (src.db.stream_connection) for the fallback path.
+        chunksize (int, optional): Rows per frame. Defaults to None (one
+            frame).
+        method (str, optional): "copy" or "sql" (pd.read_sql).
+            Defaults to "copy".
+
+    Returns:
+        pd.DataFrame: Frame, or an iterator of frames if chunksize is given
+    """
+    if (method == "copy") & (con.dialect.name in COPY_DIALECTS):
+        try:
+            return copy_extract(stmt, con, chunksize=chunksize)
+        except (pa.ArrowInvalid, con.dialect.dbapi.Error) as e:
+            logger.warning(f"COPY extract failed, using read_sql: {e}")
+            con.rollback()
+    return pd.read_sql(stmt, con=con, chunksize=chunksize)
@@ -0,0 +1,37 @@
+"""Deferred imports for heavy modules.
+
+``plt = lazy_import("matplotlib.pyplot")`` returns a placeholder that imports
+the module the first time one of its attributes is used, so importing a src
+module (e.g. for a CLI command) does not pay for libraries the command never
+touches. Annotations that name lazily imported modules need
+``from __future__ import annotations`` so they are not evaluated at import.
+"""
+import importlib
+import sys
+from types import ModuleType
+
+
+class _LazyModule(ModuleType):
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self.__name__)
+        # Later lookups go straight to the real module
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Imports a module on first attribute access
+
+    Args:
+        name (str): Absolute module name, e.g. "matplotlib.pyplot"
+
+    Returns:
+        ModuleType: The module if it is already imported, otherwise a
+            placeholder that imports it when used
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
@@ -0,0 +1,229 @@
+"""Bulk write-back of DataFrames to the database.
+
+write_frame loads a frame into a staging table in the target schema and
+then, in the same transaction, moves it into place:
+
+    replace    drop the target and rename the staging table to it
+    append     insert the staged rows into the target
+    upsert     delete target rows whose key matches a staged row, then
+               insert the staged rows
+
+PostgreSQL runs DDL inside transactions, so readers see either the old or
+the new table and a failed load leaves nothing behind. Rows are loaded with
+COPY ... FROM STDIN (PostgreSQL) or multi-row INSERTs in batches of
+DB_LOAD_BATCH_SIZE rows.
+"""
+import io
+import logging
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection, Engine
+
+from src.db import get_engine
+from src.extract import COPY_DIALECTS
+
+logger = logging.getLogger(__name__)
+
+WRITE_MODES = ("replace", "append", "upsert")
+# PostgreSQL accepts at most 65535 bound parameters per statement
+MAX_PARAMS = 32767
+
+
+def _arrow_table(df: pd.DataFrame) -> pa.Table:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # COPY needs the category values, not dictionary codes
+    return table.cast(
+        pa.schema([
+            pa.field(f.name, f.type.value_type)
+            if pa.types.is_dictionary(f.type) else f for f in table.schema
+        ]))
+
+
+def copy_frame(df: pd.DataFrame,
+               table: str,
+               con: Connection,
+               schema: str = None,
+               batch_size: int = 100000) -> None:
+    """Loads rows with COPY ... FROM STDIN in CSV format
+
+    Nulls are written unquoted and empty strings quoted, which COPY reads
+    back as NULL and '' respectively.
+
+    Args:
+        df (pd.DataFrame): Rows, with columns named as in the table
+        table (str): Existing table
+        con (Connection): PostgreSQL (psycopg2) connection
+        schema (str, optional): Schema of table. Defaults to None.
+        batch_size (int, optional): Rows written per COPY. Defaults to
+            100000.
+    """
+    preparer = con.dialect.identifier_preparer
+    columns = ", ".join(preparer.quote(str(c)) for c in df.columns)
+    sql = (f"COPY {_qualified(con, table, schema)} ({columns}) "
+           "FROM STDIN WITH (FORMAT csv)")
+    cursor = con.connection.cursor()
+    try:
+        for start in range(0, len(df), batch_size):
+            buffer = io.BytesIO()
+            pacsv.write_csv(_arrow_table(df.iloc[start:start + batch_size]),
+                            buffer,
+                            pacsv.WriteOptions(include_header=False))
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+    finally:
+        cursor.close()
+
+
+def insert_frame(df: pd.DataFrame,
+                 table: str,
+                 con: Connection,
+                 schema: str = None,
+                 batch_size: int = 10000) -> None:
+    """Loads rows with multi-row INSERT statements
+
+    Args:
+        df (pd.DataFrame): Rows, with columns named as in the table
+        table (str): Existing table
+        con (Connection): Connection
+        schema (str, optional): Schema of table. Defaults to None.
+        batch_size (int, optional): Rows per INSERT, lowered so a statement
+            stays under MAX_PARAMS parameters. Defaults to 10000.
+    """
+    max_rows = MAX_PARAMS // max(len(df.columns), 1)
+    batch_size = max(1, min(batch_size, max_rows))
+    df.to_sql(table,
+              con,
+              schema=schema,
+              if_exists="append",
+              index=False,
+              chunksize=batch_size,
+              method="multi")
+
+
+def _qualified(con: Connection, table: str, schema: str = None) -> str:
+    preparer = con.dialect.identifier_preparer
+    name = preparer.quote(table)
+    return f"{preparer.quote_schema(schema)}.{name}" if schema else name
+
+
+def _reflect(con: Connection, table: str, schema: str = None) -> sa.Table:
+    return sa.Table(table, sa.MetaData(), schema=schema, autoload_with=con)
+
+
+def _merge_staged(con: Connection, staging: str, table: str, schema: str,
+                  mode: str, key: list) -> None:
+    staged = _reflect(con, staging, schema)
+    target = _reflect(con, table, schema)
+    missing = set(staged.c.keys()) - set(target.c.keys())
+    if missing:
+        raise ValueError(f"{table} has no columns {sorted(missing)}")
+    if mode == "upsert":
+        match = sa.and_(*[staged.c[k] == target.c[k] for k in key])
+        con.execute(sa.delete(target).where(sa.exists().where(match)))
+    columns = [c.name for c in staged.columns]
+    con.execute(
+        sa.insert(target).from_select(columns,
+                                      sa.select(*staged.columns)))
+    staged.drop(con)
+
+
+def _swap_staged(con: Connection, staging: str, table: str, schema: str,
+                 exists: bool, key: list) -> None:
+    if exists:
+        con.execute(sa.text(f"DROP TABLE {_qualified(con, table, schema)}"))
+    new_name = con.dialect.identifier_preparer.quote(table)
+    con.execute(
+        sa.text(f"ALTER TABLE {_qualified(con, staging, schema)} "
+                f"RENAME TO {new_name}"))
+    if key:
+        target = _reflect(con, table, schema)
+        sa.Index(f"ix_{table}_{'_'.join(key)}",
+                 *[target.c[k] for k in key]).create(con)
+
+
+def _drop_staging(engine: Engine, staging: str, schema: str) -> None:
+    # Drivers without transactional DDL (e.g. pysqlite) keep the staging
+    # table after a rollback. Called while handling a failed load, so a
+    # cleanup error is logged rather than raised over the original one.
+    try:
+        with engine.begin() as con:
+            con.execute(
+                sa.text("DROP TABLE IF EXISTS "
+                        f"{_qualified(con, staging, schema)}"))
+    except Exception as e:
+        logger.warning(f"Could not drop staging table {staging}: {e}")
+
+
+def write_frame(df: pd.DataFrame,
+                table: str,
+                engine: Engine = None,
+                schema: str = None,
+                mode: str = "replace",
+                key: list = None,
+                method: str = None,
+                batch_size: int = None) -> int:
+    """Bulk loads a DataFrame into a table through a staging table
+
+    The index is not written; reset_index() first to keep it.
+
+    Args:
+        df (pd.DataFrame): Frame to write
+        table (str): Target table. Created from the frame's dtypes if it
+            does not exist.
+        engine (Engine, optional): Engine. Defaults to get_engine().
+        schema (str, optional): Schema of table. Defaults to None.
+        mode (str, optional): One of WRITE_MODES. "replace" does not keep
+            the old table's indexes, grants or dependent views. Defaults to
+            "replace".
+        key (list, optional): Columns identifying rows, required for
+            "upsert". A key may match many rows (e.g. person_id in long
+            data); all of them are replaced. With "replace" an index is
+            created on the key. Defaults to None.
+        method (str, optional): "copy" or "insert". Defaults to None (copy
+            where the database supports it).
+        batch_size (int, optional): Rows per COPY or INSERT. Defaults to the
+            DB_LOAD_BATCH_SIZE environment variable or 10000.
+
+    Raises:
+        ValueError: Unknown mode or method, upsert without a key, or a
+            column missing from an existing table
+
+    Returns:
+        int: Rows written
+    """
+    if mode not in WRITE_MODES:
+        raise ValueError(f"mode must be one of {WRITE_MODES}, not {mode!r}")
+    if isinstance(key, str):
+        key = [key]
+    if (mode == "upsert") & (not key):
+        raise ValueError("upsert needs a key")
+    engine = engine if engine is not None else get_engine()
+    if method is None:
+        method = "copy" if engine.dialect.name in COPY_DIALECTS else "insert"
+    if method not in ("copy", "insert"):
+        raise ValueError(f"method must be 'copy' or 'insert', not {method!r}")
+    if batch_size is None:
+        batch_size = int(os.getenv("DB_LOAD_BATCH_SIZE", 10000))
+    load = copy_frame if method == "copy" else insert_frame
+    staging = f"{table}_staging_{uuid.uuid4().hex[:8]}"
+
+    try:
+        with engine.begin() as con:
+            exists = sa.inspect(con).has_table(table, schema=schema)
+            df.head(0).to_sql(staging, con, schema=schema, index=False)
+            load(df, staging, con, schema=schema, batch_size=batch_size)
+            if (exists is True) & (mode != "replace"):
+                _merge_staged(con, staging, table, schema, mode, key)
+            else:
+                _swap_staged(con, staging, table, schema, exists, key)
+    except Exception:
+        _drop_staging(engine, staging, schema)
+        raise
+    logger.info(f"Wrote {len(df)} rows to {schema or ''}.{table} ({mode}, "
+                f"{method})")
+    return len(df)
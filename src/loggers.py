@@ -9,14 +9,18 @@ from os.path import abspath, join
 from traceback import extract_tb, format_exception_only, format_list
 from typing import List
 
-import urllib3
-from IPython import get_ipython
-from termcolor import colored
-
 import src.config as config
 
 LOGGER = logging.getLogger(__name__)
-IPYTHON = get_ipython()
+
+
+def ipython_shell():
+    # IPython can only be running if it was already imported, so a CLI run
+    # does not need to import it to find out
+    if "IPython" not in sys.modules:
+        return None
+    from IPython import get_ipython
+    return get_ipython()
 
 
 def _set_lib_loggers(level: str, noisyLibs: list) -> None:
@@ -28,7 +32,9 @@ def _set_lib_loggers(level: str, noisyLibs: list) -> None:
     for lib in noisyLibs:
         logging.getLogger(lib).setLevel(level=level)
 
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    # urllib3's InsecureRequestWarning, filtered by message so urllib3 is
+    # not imported
+    warnings.filterwarnings("ignore", message="Unverified HTTPS request")
     warnings.filterwarnings("ignore", category=DeprecationWarning)
     warnings.filterwarnings("ignore", category=FutureWarning)
 
@@ -63,6 +69,7 @@ def set_cli_errors(level: str, logger: logging.Logger = LOGGER) -> None:
                           exception,
                           tb,
                           debug_hook=sys.excepthook):
+        from termcolor import colored
 
         logger.error(f"""{colored(exception_type.__name__, 'red')}: \n
             {colored(exception, 'yellow')}""")
@@ -108,6 +115,7 @@ def setup_logging(verbose=None, logger=LOGGER) -> object:
             {logger.getEffectiveLevel()}")
 
     # Configure ipython error handling
+    IPYTHON = ipython_shell()
     if IPYTHON:
         logger.debug(f"ipython level: {level}")
         if level == "INFO":
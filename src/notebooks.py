@@ -0,0 +1,389 @@
+"""Executes notebooks in-process on a pool of pre-warmed kernels.
+
+Starting a kernel and importing pandas, seaborn and scikit-learn is often
+most of the render time of a short report. A KernelPool starts kernels ahead
+of time, runs the warm-up imports in them and hands them out one notebook at
+a time. Between notebooks the kernel's namespace is reset, but imported
+modules stay loaded, so module level state (e.g. pandas options or
+matplotlib rcParams) set by one notebook is visible to the next.
+
+Set KERNEL_POOL_SIZE to the number of kernels kept by the shared pool.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+import jupytext
+import nbformat
+from jupyter_client.manager import KernelManager
+from nbclient import NotebookClient
+from nbclient.exceptions import CellExecutionError
+from nbconvert import HTMLExporter
+
+logger = logging.getLogger(__name__)
+
+# src is left out: importing it changes directory to PROJECT_ROOT, which a
+# notebook relies on, so each notebook must import it afresh
+DEFAULT_WARMUP = """\
+import matplotlib.pyplot
+import numpy
+import pandas
+import seaborn
+import sklearn
+"""
+
+# Unloading the project's modules makes the next notebook's `import src` run
+# again (and change directory), as it would in a fresh kernel
+_RESET = """\
+%reset -f
+import matplotlib.pyplot as _plt
+_plt.close("all")
+del _plt
+import os as _os
+import sys as _sys
+[_sys.modules.pop(_m) for _m in list(_sys.modules)
+ if _m == "src" or _m.startswith("src.")]
+_os.chdir({cwd!r})
+del _os, _sys
+"""
+
+
+class KernelPool:
+    """Pool of started kernels that have already run warm-up code
+
+    Example:
+        with KernelPool(size=2) as pool:
+            nb, timings = execute_notebook(nb, pool)
+
+    Args:
+        size (int, optional): Max kernels. Defaults to 1.
+        kernel_name (str, optional): Kernel spec. Defaults to "python3".
+        warmup (str, optional): Code run once when a kernel starts.
+            Defaults to DEFAULT_WARMUP (the project's analysis stack).
+        cwd (Path, optional): Kernel working directory. Defaults to
+            PROJECT_ROOT.
+        startup_timeout (int, optional): Seconds to wait for a kernel to
+            start. Defaults to 60.
+        acquire_timeout (int, optional): Seconds to wait for a kernel when
+            all of them are busy. Defaults to 600.
+    """
+    def __init__(self,
+                 size: int = 1,
+                 kernel_name: str = "python3",
+                 warmup: str = DEFAULT_WARMUP,
+                 cwd: Path = None,
+                 startup_timeout: int = 60,
+                 acquire_timeout: int = 600):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.warmup = warmup
+        self.cwd = Path(cwd or os.getenv("PROJECT_ROOT", "."))
+        self.startup_timeout = startup_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"KernelPool(size={self.size}, started={self._started}, "
+                f"kernel_name={self.kernel_name})")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def start(self) -> "KernelPool":
+        """Starts and warms up kernels until the pool is full
+
+        Raises:
+            Exception: The first error of a kernel that failed to start.
+                Kernels that did start are kept.
+        """
+        with self._lock:
+            missing = self.size - self._started
+            self._started += missing
+        if missing <= 0:
+            return self
+        errors = []
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [
+                executor.submit(self._start_kernel) for _ in range(missing)
+            ]
+            for future in futures:
+                try:
+                    self._idle.put(future.result())
+                except Exception as e:
+                    # Free the slot so _acquire can try again
+                    with self._lock:
+                        self._started -= 1
+                    errors.append(e)
+        if errors:
+            logger.error(f"{len(errors)} of {missing} kernels failed to "
+                         f"start: {errors[0]!r}")
+            raise errors[0]
+        return self
+
+    @contextmanager
+    def kernel(self) -> Iterator[KernelManager]:
+        """Borrows a warm kernel, starting one if the pool is not full
+
+        The kernel's namespace, project modules and working directory are
+        reset when it is returned. Kernels that died or could not be reset
+        are replaced.
+
+        Yields:
+            KernelManager: Started kernel
+        """
+        km = self._acquire()
+        healthy = False
+        try:
+            yield km
+            healthy = True
+        except CellExecutionError:
+            # The notebook failed but the kernel is fine
+            healthy = True
+            raise
+        finally:
+            reset = _RESET.format(cwd=str(self.cwd))
+            if healthy and km.is_alive() and self._run(km, reset):
+                self._idle.put(km)
+            else:
+                logger.info("Replacing kernel")
+                self._discard(km)
+
+    def shutdown(self) -> None:
+        """Shuts down idle kernels"""
+        while True:
+            try:
+                km = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(km)
+
+    def _acquire(self) -> KernelManager:
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._reserve():
+                return self._start_reserved()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No kernel was free after "
+                                   f"{self.acquire_timeout}s")
+            try:
+                # Wake up periodically in case a kernel start failed and
+                # freed a slot
+                return self._idle.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                continue
+
+    def _reserve(self) -> bool:
+        """Claims a slot for a new kernel if the pool is not full"""
+        with self._lock:
+            if self._started < self.size:
+                self._started += 1
+                return True
+        return False
+
+    def _start_reserved(self) -> KernelManager:
+        try:
+            return self._start_kernel()
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+
+    def _discard(self, km: KernelManager) -> None:
+        with self._lock:
+            self._started -= 1
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception as e:
+            logger.debug(f"Kernel shutdown failed: {e}")
+
+    def _start_kernel(self) -> KernelManager:
+        start = time.perf_counter()
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel(cwd=str(self.cwd))
+        if self.warmup and not self._run(km, self.warmup):
+            logger.warning("Kernel warm-up failed")
+        logger.info(f"Started kernel in {time.perf_counter() - start:.1f}s")
+        return km
+
+    def _run(self, km: KernelManager, code: str) -> bool:
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+            reply = kc.execute_interactive(code,
+                                           silent=True,
+                                           store_history=False,
+                                           output_hook=lambda msg: None,
+                                           timeout=self.startup_timeout)
+            return reply["content"]["status"] == "ok"
+        except (RuntimeError, TimeoutError) as e:
+            logger.warning(f"Kernel did not respond: {e}")
+            return False
+        finally:
+            kc.stop_channels()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_kernel_pool() -> KernelPool:
+    """Shared KernelPool of KERNEL_POOL_SIZE kernels (default 1)"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = KernelPool(size=int(os.getenv("KERNEL_POOL_SIZE", 1)))
+            atexit.register(_POOL.shutdown)
+    return _POOL
+
+
+class _StreamingClient(NotebookClient):
+    """NotebookClient that passes each output to a callback as it arrives"""
+    def __init__(self, nb, on_output: Callable = None, **kwargs):
+        super().__init__(nb, **kwargs)
+        self.on_output = on_output
+
+    def output(self, outs, msg, display_id, cell_index):
+        out = super().output(outs, msg, display_id, cell_index)
+        if out is not None and self.on_output is not None:
+            self.on_output(cell_index, out)
+        return out
+
+
+def log_output(name: str) -> Callable:
+    """Output callback that logs a notebook's text outputs
+
+    Args:
+        name (str): Notebook name used as the log prefix
+
+    Returns:
+        Callable: on_output callback for execute_notebook
+    """
+    def on_output(cell_index: int, output: nbformat.NotebookNode) -> None:
+        text = output.get("text")
+        if text is None and output.get("output_type") == "error":
+            text = f"{output['ename']}: {output['evalue']}"
+        if text:
+            logger.info(f"[{name}] cell {cell_index}: {text.rstrip()}")
+
+    return on_output
+
+
+def execute_notebook(nb: nbformat.NotebookNode,
+                     pool: KernelPool = None,
+                     cwd: Path = None,
+                     timeout: int = None,
+                     on_output: Callable = None) -> tuple:
+    """Executes a notebook in-process on a warm kernel
+
+    Args:
+        nb (nbformat.NotebookNode): Notebook. Executed in place.
+        pool (KernelPool, optional): Kernels. Defaults to None
+            (get_kernel_pool()).
+        cwd (Path, optional): Working directory for the notebook. Defaults
+            to None (the kernel's directory).
+        timeout (int, optional): Seconds allowed per cell. Defaults to None
+            (no limit).
+        on_output (Callable, optional): Called with (cell index, output) for
+            every output as it arrives. Defaults to None.
+
+    Raises:
+        CellExecutionError: A cell raised an error
+
+    Returns:
+        tuple: (executed notebook, [{"cell": index, "seconds": seconds}])
+    """
+    pool = pool if pool is not None else get_kernel_pool()
+    timings = []
+    with pool.kernel() as km:
+        if cwd is not None:
+            pool._run(km, f"import os as _os\n_os.chdir({str(cwd)!r})\n"
+                      "del _os")
+        client = _StreamingClient(nb,
+                                  on_output=on_output,
+                                  km=km,
+                                  timeout=timeout)
+        try:
+            with client.setup_kernel():
+                for index, cell in enumerate(nb.cells):
+                    start = time.perf_counter()
+                    client.execute_cell(cell, index)
+                    if cell.cell_type == "code":
+                        seconds = time.perf_counter() - start
+                        timings.append({"cell": index, "seconds": seconds})
+                        logger.debug(f"Cell {index} ran in {seconds:.2f}s")
+        finally:
+            # The pool owns the kernel, so only this client is closed
+            if client.kc is not None:
+                client.kc.stop_channels()
+    return nb, timings
+
+
+def render_script(script: Path,
+                  output_path: Path = None,
+                  output_name: str = None,
+                  pool: KernelPool = None,
+                  timeout: int = None,
+                  on_output: Callable = None) -> Path:
+    """Converts a .py script to a notebook, executes it and exports html
+
+    The executed notebook is saved next to the html.
+
+    Args:
+        script (Path): jupytext script
+        output_path (Path, optional): Output directory. Defaults to None
+            (the script's directory).
+        output_name (str, optional): Name of output files (no extension).
+            Defaults to None (script name).
+        pool (KernelPool, optional): Kernels. Defaults to None
+            (get_kernel_pool()).
+        timeout (int, optional): Seconds allowed per cell. Defaults to None.
+        on_output (Callable, optional): Output callback. Defaults to None
+            (log_output).
+
+    Raises:
+        CellExecutionError: A cell raised an error
+        DeadKernelError: The kernel died (nbclient.exceptions)
+
+    Returns:
+        Path: html file
+    """
+    script = Path(script)
+    output_path = Path(output_path or script.parent)
+    output_name = output_name or script.stem
+    if on_output is None:
+        on_output = log_output(output_name)
+    start = time.perf_counter()
+    nb = jupytext.read(script)
+    nb, timings = execute_notebook(nb,
+                                   pool=pool,
+                                   cwd=script.parent,
+                                   timeout=timeout,
+                                   on_output=on_output)
+    slowest = sorted(timings, key=lambda t: t["seconds"])[-3:]
+    logger.info(f"Executed {script.name} in "
+                f"{time.perf_counter() - start:.1f}s. Slowest cells: " +
+                ", ".join(f"{t['cell']} ({t['seconds']:.1f}s)"
+                          for t in reversed(slowest)))
+    nbformat.write(nb, Path(output_path, f"{output_name}.ipynb"))
+    body, _ = HTMLExporter(template_name="classic").from_notebook_node(nb)
+    html = Path(output_path, f"{output_name}.html")
+    html.write_text(body, encoding="utf-8")
+    return html
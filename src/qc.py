@@ -0,0 +1,266 @@
+"""Streaming data quality reports built from mergeable sketches.
+
+A QualityReport is updated one chunk at a time, so it never needs more than
+one chunk of a frame in memory, and two reports built on different chunks
+(or processes) can be merged. Per column it tracks counts, nulls, min/max,
+approximate quantiles from a reservoir sample and a HyperLogLog estimate of
+distinct values. Duplicate rows are detected from 64-bit row hashes.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def hash_rows(df: pd.DataFrame, subset: list = None) -> np.ndarray:
+    """Hashes rows (or a subset of columns) to 64 bits
+
+    Args:
+        df (pd.DataFrame or pd.Series): DataFrame
+        subset (list, optional): Columns to hash. Defaults to None (all).
+
+    Returns:
+        np.ndarray: uint64 hash per row
+    """
+    if subset is not None:
+        df = df[subset]
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+class HyperLogLog:
+    """HyperLogLog distinct count estimator over 64-bit hashes
+
+    Args:
+        p (int, optional): Precision. Uses 2**p registers (standard error
+            about 1.04 / sqrt(2**p)). Defaults to 12.
+    """
+    def __init__(self, p: int = 12):
+        self.p = p
+        self.registers = np.zeros(2**p, dtype=np.uint8)
+
+    def update(self, hashes: np.ndarray) -> None:
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(hashes):
+            return
+        bits = 64 - self.p
+        idx = (hashes >> np.uint64(bits)).astype(np.intp)
+        w = hashes & np.uint64((1 << bits) - 1)
+        # Rank is the position of the leftmost 1 bit in the low bits. w fits
+        # in a float64 exactly, so frexp gives floor(log2(w)) + 1 exactly.
+        _, exponent = np.frexp(w.astype(np.float64))
+        rank = np.where(w == 0, bits + 1, bits - exponent + 1)
+        np.maximum.at(self.registers, idx, rank.astype(np.uint8))
+
+    def merge(self, other: "HyperLogLog") -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0**-self.registers.astype(float))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class ColumnSketch:
+    """Mergeable summary of one column
+
+    Args:
+        sample_size (int, optional): Reservoir size used for approximate
+            quantiles. Defaults to 10000.
+        seed (int, optional): Random seed for the reservoir. Defaults to 0.
+    """
+    def __init__(self, sample_size: int = 10000, seed: int = 0):
+        self.dtype = None
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.distinct = HyperLogLog()
+        self.sample_size = sample_size
+        self.sample = np.empty(0)
+        self.sampled_from = 0
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, s: pd.Series) -> None:
+        self.dtype = s.dtype if self.dtype is None else self.dtype
+        valid = s.dropna()
+        self.count += len(s)
+        self.nulls += len(s) - len(valid)
+        if not len(valid):
+            return
+        self.distinct.update(hash_rows(valid))
+        self._update_range(valid)
+        if pd.api.types.is_numeric_dtype(valid) and \
+                not pd.api.types.is_bool_dtype(valid):
+            self._update_sample(valid.to_numpy(dtype=float), len(valid))
+
+    def merge(self, other: "ColumnSketch") -> None:
+        self.dtype = other.dtype if self.dtype is None else self.dtype
+        self.count += other.count
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        for value in (other.min, other.max):
+            if value is not None:
+                self._update_range(pd.Series([value]))
+        if other.sampled_from:
+            self._update_sample(other.sample, other.sampled_from)
+
+    def quantiles(self, q: list) -> list:
+        if not len(self.sample):
+            return [None] * len(q)
+        return list(np.quantile(self.sample, q))
+
+    def _update_range(self, valid: pd.Series) -> None:
+        try:
+            lo, hi = valid.min(), valid.max()
+            self.min = lo if self.min is None else min(self.min, lo)
+            self.max = hi if self.max is None else max(self.max, hi)
+        except TypeError:
+            # Unorderable values (e.g. mixed types)
+            pass
+
+    def _update_sample(self, values: np.ndarray, n: int) -> None:
+        # Weighted merge of two uniform samples keeps the result uniform
+        total = self.sampled_from + n
+        if len(self.sample) + len(values) <= self.sample_size:
+            self.sample = np.concatenate([self.sample, values])
+        else:
+            take = self._rng.binomial(self.sample_size,
+                                      self.sampled_from / total)
+            take = min(take, len(self.sample))
+            take_new = min(self.sample_size - take, len(values))
+            self.sample = np.concatenate([
+                self._rng.choice(self.sample, take, replace=False),
+                self._rng.choice(values, take_new, replace=False),
+            ])
+        self.sampled_from = total
+
+
+class QualityReport:
+    """Streaming quality control report for a DataFrame
+
+    Args:
+        subset (list, optional): Columns that identify a duplicate row.
+            Defaults to None (all columns).
+        sample (float or int, optional): Fraction (float) or approximate
+            number of rows (int) used for column statistics. Duplicates are
+            always checked on every row. Defaults to None (all rows).
+        seed (int, optional): Random seed for sampling. Defaults to 0.
+    """
+    quantile_levels = [0.25, 0.5, 0.75]
+
+    def __init__(self, subset: list = None, sample=None, seed: int = 0):
+        self.subset = subset
+        self.sample = sample
+        self.rows = 0
+        self.columns = {}
+        self._key_hashes = []
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, chunk: pd.DataFrame, total_rows: int = None) -> None:
+        """Adds a chunk of rows to the report
+
+        Args:
+            chunk (pd.DataFrame): Rows to add
+            total_rows (int, optional): Rows in the whole frame, used to turn
+                an int sample into a fraction. Defaults to len(chunk).
+        """
+        self.rows += len(chunk)
+        self._key_hashes.append(hash_rows(chunk, self.subset))
+        stats_rows = self._sample(chunk, total_rows or len(chunk))
+        for col in chunk:
+            sketch = self.columns.setdefault(col, ColumnSketch())
+            sketch.update(stats_rows[col])
+
+    def merge(self, other: "QualityReport") -> None:
+        """Merges a report built on other rows of the same frame"""
+        self.rows += other.rows
+        self._key_hashes.extend(other._key_hashes)
+        for col, sketch in other.columns.items():
+            self.columns.setdefault(col, ColumnSketch()).merge(sketch)
+
+    @property
+    def duplicates(self) -> int:
+        """Rows whose subset key (by 64-bit hash) was already seen"""
+        # Deduplicate across chunks once, on demand
+        if len(self._key_hashes) != 1:
+            self._key_hashes = [_sorted_unique(self._key_hashes)]
+        return self.rows - len(self._key_hashes[0])
+
+    def to_frame(self) -> pd.DataFrame:
+        """One row of statistics per column"""
+        records = {}
+        for col, sketch in self.columns.items():
+            record = {
+                "dtype": str(sketch.dtype),
+                "count": sketch.count,
+                "nulls": sketch.nulls,
+                "null_pct": sketch.nulls / sketch.count if sketch.count else 0,
+                "distinct_approx": sketch.distinct.count(),
+                "min": sketch.min,
+                "max": sketch.max,
+            }
+            for q, value in zip(self.quantile_levels,
+                                sketch.quantiles(self.quantile_levels)):
+                record[f"p{int(q * 100)}"] = value
+            records[col] = record
+        return pd.DataFrame.from_dict(records, orient="index")
+
+    def __repr__(self):
+        return (f"QualityReport(rows={self.rows}, "
+                f"duplicates={self.duplicates}, subset={self.subset})\n"
+                f"{self.to_frame()}")
+
+    def _repr_html_(self):
+        return (f"<p>rows={self.rows}, duplicates={self.duplicates} "
+                f"(subset={self.subset})</p>" + self.to_frame()._repr_html_())
+
+    def _sample(self, chunk: pd.DataFrame, total_rows: int) -> pd.DataFrame:
+        if self.sample is None:
+            return chunk
+        frac = self.sample
+        if isinstance(frac, int):
+            frac = frac / total_rows
+        if frac >= 1:
+            return chunk
+        return chunk[self._rng.random(len(chunk)) < frac]
+
+
+def _sorted_unique(arrays: list) -> np.ndarray:
+    # A sort plus neighbour comparison is faster than np.unique for hashes
+    if not arrays:
+        return np.empty(0, dtype=np.uint64)
+    a = np.concatenate(arrays)
+    a.sort()
+    keep = np.ones(len(a), dtype=bool)
+    keep[1:] = a[1:] != a[:-1]
+    return a[keep]
+
+
+def build_quality_report(df: pd.DataFrame,
+                         subset: list = None,
+                         sample=None,
+                         chunksize: int = 100000) -> QualityReport:
+    """Builds a QualityReport in one pass over a DataFrame
+
+    Args:
+        df (pd.DataFrame): DataFrame to check
+        subset (list, optional): Columns that identify a duplicate row.
+            Defaults to None (all columns).
+        sample (float or int, optional): Fraction or number of rows used for
+            column statistics. Defaults to None (all rows).
+        chunksize (int, optional): Rows per chunk. Defaults to 100000.
+
+    Returns:
+        QualityReport: Report
+    """
+    report = QualityReport(subset=subset, sample=sample)
+    for start in range(0, len(df), chunksize):
+        report.update(df.iloc[start:start + chunksize], total_rows=len(df))
+    return report
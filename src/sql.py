@@ -0,0 +1,171 @@
+"""Builds SQLAlchemy queries from Data table specs.
+
+A table spec is compiled into one SELECT so projection, renames, casts, row
+filters and simple category recodes run in the database and only the final
+columns cross the wire.
+"""
+import logging
+import operator
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger(__name__)
+
+# pandas dtype names that have a direct SQL equivalent. Other dtypes (e.g.
+# category) are applied in pandas after the query.
+SQL_TYPES = {
+    "int8": sa.SmallInteger,
+    "int16": sa.SmallInteger,
+    "int32": sa.Integer,
+    "int64": sa.BigInteger,
+    "Int8": sa.SmallInteger,
+    "Int16": sa.SmallInteger,
+    "Int32": sa.Integer,
+    "Int64": sa.BigInteger,
+    "float32": sa.REAL,
+    "float64": sa.Float,
+    "Float32": sa.REAL,
+    "Float64": sa.Float,
+    "bool": sa.Boolean,
+    "boolean": sa.Boolean,
+    "str": sa.String,
+    "string": sa.String,
+    "datetime64[ns]": sa.DateTime,
+}
+
+
+def build_select(table: str,
+                 schema: str = None,
+                 columns: list = None,
+                 date_col: str = None,
+                 start: datetime = None,
+                 end: datetime = None,
+                 after: datetime = None,
+                 until: datetime = None,
+                 dtype: dict = None,
+                 where: dict = None,
+                 recodes: dict = None) -> Select:
+    """Builds a SELECT for a table spec
+
+    Args:
+        table (str): Name of table
+        schema (str, optional): Database schema. Defaults to None.
+        columns (list or dict, optional): Columns to select, or
+            {<database column>: <new column name>} to also rename them.
+            Defaults to None (all).
+        date_col (str, optional): Date column used to filter rows.
+            Defaults to None.
+        start (datetime, optional): Keep rows with date_col >= start.
+        end (datetime, optional): Keep rows with date_col <= end.
+        after (datetime, optional): Keep rows with date_col > after. Used
+            for incremental refreshes from a high-water mark.
+        until (datetime, optional): Keep rows with date_col <= until or
+            NULL. Used to cap a fetch at the high-water mark recorded for
+            it.
+        dtype (dict, optional): {<new column name>: <pandas dtype>}. Dtypes
+            in SQL_TYPES are cast in the query. Defaults to None.
+        where (dict, optional): Row filters on database columns as
+            {<column>: <value>}. A list, tuple or set value is an IN filter
+            and None is an IS NULL filter. Defaults to None.
+        recodes (dict, optional): {<new column name>: {<old>: <new>}}
+            value recodes compiled to CASE expressions. Defaults to None.
+
+    Returns:
+        Select: Query
+    """
+    if isinstance(columns, dict):
+        labels = columns
+    else:
+        labels = {c: c for c in columns or []}
+    where = where or {}
+    names = list(labels) + [c for c in where if c not in labels]
+    # Typing the date column converts bound datetimes for the dialect without
+    # wrapping the column in a CAST that would defeat its index
+    source = sa.table(table,
+                      *[sa.column(c) for c in names if c != date_col],
+                      schema=schema)
+    if date_col is not None:
+        source.append_column(sa.column(date_col, sa.DateTime))
+
+    if labels:
+        stmt = sa.select(*[
+            _column_expression(source.c[c], label, dtype, recodes)
+            for c, label in labels.items()
+        ])
+    else:
+        stmt = sa.select(sa.text("*")).select_from(source)
+
+    stmt = stmt.where(*_where_clauses(source, where))
+    if date_col is not None:
+        date = source.c[date_col]
+        bounds = [(operator.ge, start), (operator.le, end),
+                  (operator.gt, after)]
+        stmt = stmt.where(
+            *[op(date, v) for op, v in bounds if v is not None])
+        if until is not None:
+            stmt = stmt.where(sa.or_(date <= until, date.is_(None)))
+    logger.debug(f"Query: {stmt}")
+    return stmt
+
+
+def _where_clauses(source: sa.TableClause, where: dict) -> list:
+    clauses = []
+    for c, value in where.items():
+        col = source.c[c]
+        if value is None:
+            clauses.append(col.is_(None))
+        elif isinstance(value, (list, tuple, set)):
+            clauses.append(col.in_(list(value)))
+        else:
+            clauses.append(col == value)
+    return clauses
+
+
+def _result_type(values) -> type:
+    # SQL type shared by the new values of a recode, or None when there is
+    # none (e.g. dates), in which case the CASE is left untyped
+    kinds = {type(v) for v in values if v is not None}
+    if not kinds:
+        return None
+    if kinds <= {bool}:
+        return sa.Boolean
+    if kinds <= {bool, int}:
+        return sa.BigInteger
+    if kinds <= {bool, int, float}:
+        return sa.Float
+    if str in kinds:
+        return sa.String
+    return None
+
+
+def _recode_expression(col: sa.ColumnClause,
+                       recode: dict) -> sa.ColumnElement:
+    # Every branch of a CASE must have one type (PostgreSQL rejects e.g.
+    # integer codes falling through next to text labels), so unmapped values
+    # are cast to the type of the new values. A recode mixing text and
+    # numbers is recoded to text.
+    sql_type = _result_type(recode.values())
+    if sql_type is None:
+        return sa.case(recode, value=col, else_=col)
+    whens = {
+        old: None if new is None else sa.literal(
+            str(new) if sql_type is sa.String else new, sql_type)
+        for old, new in recode.items()
+    }
+    return sa.case(whens, value=col, else_=sa.cast(col, sql_type))
+
+
+def _column_expression(col: sa.ColumnClause, label: str, dtype: dict,
+                       recodes: dict) -> sa.ColumnElement:
+    expr = col
+    recode = (recodes or {}).get(label)
+    if recode:
+        expr = _recode_expression(col, recode)
+    sql_type = SQL_TYPES.get(str((dtype or {}).get(label)))
+    if sql_type is not None:
+        expr = sa.cast(expr, sql_type)
+    if expr is col and label == col.name:
+        return col
+    return expr.label(label)
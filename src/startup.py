@@ -0,0 +1,102 @@
+"""Import time benchmark for the src package and its CLI.
+
+Runs ``python -X importtime -c "import <module>"`` in fresh interpreters
+and compares the fastest run against a budget, so a heavy library imported
+at module level (instead of lazily, see src.lazy) fails the check. Set
+IMPORT_BUDGET_MS to change the default budget.
+"""
+import logging
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+import click
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET_MS = 300
+
+
+def _import_times(code: str) -> list:
+    """(module, depth, self us, cumulative us) for each import made by code"""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE,
+                             text=True,
+                             check=True)
+    times = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return times
+
+
+def measure_import_time(module: str = "src.cli", runs: int = 5) -> dict:
+    """Measures how long importing a module takes in a fresh interpreter
+
+    Imports made by interpreter startup are not counted.
+
+    Args:
+        module (str, optional): Module to import. Defaults to "src.cli".
+        runs (int, optional): Interpreters to start. The fastest run is
+            reported. Defaults to 5.
+
+    Returns:
+        dict: "total_ms" and "packages", {top level package: ms} of self
+            time from the fastest run, slowest first
+    """
+    startup = {name for name, _, _, _ in _import_times("pass")}
+    best = None
+    for _ in range(runs):
+        times = [t for t in _import_times(f"import {module}")
+                 if t[0] not in startup]
+        total = sum(cumulative for _, depth, _, cumulative in times
+                    if depth == 0)
+        if best is None or total < best[0]:
+            best = (total, times)
+    total, times = best
+    packages = defaultdict(int)
+    for name, _, self_us, _ in times:
+        packages[name.split(".")[0]] += self_us
+    return {
+        "total_ms": total / 1000,
+        "packages": {
+            name: us / 1000
+            for name, us in sorted(
+                packages.items(), key=lambda p: p[1], reverse=True)
+        },
+    }
+
+
+@click.command("import-time")
+@click.option('-m',
+              '--module',
+              default="src.cli",
+              show_default=True,
+              help='Module to import')
+@click.option('-b',
+              '--budget-ms',
+              type=float,
+              help='Fail above this many milliseconds. Defaults to '
+              f'IMPORT_BUDGET_MS or {DEFAULT_BUDGET_MS}')
+@click.option('-r', '--runs', default=5, show_default=True)
+@click.option('-t',
+              '--top',
+              default=10,
+              show_default=True,
+              help='Slowest packages to show')
+def import_time_command(module, budget_ms, runs, top):
+    if budget_ms is None:
+        budget_ms = float(os.getenv("IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS))
+    result = measure_import_time(module, runs)
+    for name, ms in list(result["packages"].items())[:top]:
+        click.echo(f"{ms:8.1f} ms  {name}")
+    click.echo(f"import {module}: {result['total_ms']:.1f} ms "
+               f"(budget {budget_ms:.0f} ms)")
+    if result["total_ms"] > budget_ms:
+        click.echo("Import time is over budget", err=True)
+        sys.exit(1)
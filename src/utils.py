@@ -1,23 +1,40 @@
+from __future__ import annotations
+
+import hashlib
 import logging
 import os
 import pickle
-import shlex
-import subprocess
+import sys
+import threading
 import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from multiprocessing.util import Finalize
 from pathlib import Path
-from typing import IO, Any
+from typing import IO, TYPE_CHECKING, Any
 
 import click
-import jupytext
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
-from IPython.display import display
 
+from src.artifacts import ArtifactStore
+from src.cache import CacheManifest, spec_hash
+from src.config import configure_pandas
+from src.lazy import lazy_import
+from src.qc import QualityReport, build_quality_report
+from src.watch import wait_for_files
+
+if TYPE_CHECKING:
+    from src.notebooks import KernelPool
+
+# Plotting, modelling and notebook libraries are imported by the functions
+# that use them, so CLI commands only load what they need
+plt = lazy_import("matplotlib.pyplot")
+sns = lazy_import("seaborn")
 
 logger = logging.getLogger(__name__)
+configure_pandas()
 
 
 class ScriptException(Exception):
@@ -28,104 +45,362 @@ class ScriptException(Exception):
         Exception().__init__('Error in script')
 
 
-def plot_validation_score(
-    model: object,
-    X: pd.DataFrame,
-    y: pd.Series,
-    scorer: str,
-    param: str,
-    param_range: list,
-):
-
-    train_scores, test_scores = validation_curve(model,
-                                                 X,
-                                                 y,
-                                                 param_name=param,
-                                                 param_range=param_range,
-                                                 scoring=scorer,
-                                                 n_jobs=1)
-    train_scores_mean = np.mean(train_scores, axis=1)
-    train_scores_std = np.std(train_scores, axis=1)
-    test_scores_mean = np.mean(test_scores, axis=1)
-    test_scores_std = np.std(test_scores, axis=1)
-
-    plt.title(f"Validation Curve\n{model}\n{param}")
-    plt.xlabel(param)
-    plt.ylabel(scorer)
+def compute_validation_curve(model: object,
+                             X: pd.DataFrame,
+                             y: pd.Series,
+                             scorer: str,
+                             param: str,
+                             param_range: list,
+                             cv=None,
+                             n_jobs: int = None,
+                             backend: str = None,
+                             store: ArtifactStore = None,
+                             cached: bool = True) -> pd.DataFrame:
+    """Scores a model on every CV fold for a range of parameter values
+
+    Folds and parameter values are fitted in parallel with joblib. Scores
+    are cached per parameter value in an ArtifactStore, keyed on the
+    model's parameters, the data, the scorer and the CV splitter, so
+    re-plotting or extending param_range only fits the new values. Cached
+    scores are only comparable when cv splits deterministically (e.g. an
+    int or a splitter with a fixed random_state).
+
+    Args:
+        model (object): scikit-learn estimator
+        X (pd.DataFrame): Feature dataset
+        y (pd.Series): labels
+        scorer (str): scikit-learn scoring name
+        param (str): Name of the parameter to vary
+        param_range (list): Parameter values
+        cv (int or splitter, optional): Cross-validation strategy.
+            Defaults to None (5-fold).
+        n_jobs (int, optional): Parallel jobs. Defaults to N_JOBS or -1
+            (all cores).
+        backend (str, optional): joblib backend, e.g. "loky",
+            "multiprocessing" or "threading". Defaults to None (joblib's
+            default).
+        store (ArtifactStore, optional): Store for cached scores. Defaults
+            to None (ArtifactStore()).
+        cached (bool, optional): Reuse and save cached scores.
+            Defaults to True.
+
+    Returns:
+        pd.DataFrame: One row per parameter value and fold with columns
+            param, "fold", "train" and "test"
+    """
+    from joblib import parallel_config
+    from sklearn.base import clone
+    from sklearn.model_selection import validation_curve
+
+    if n_jobs is None:
+        n_jobs = int(os.getenv("N_JOBS", -1))
+    model = clone(model)
+    if cached is True:
+        store = store if store is not None else ArtifactStore()
+        keys = {
+            value: ArtifactStore.key("validation_curve", model, X, y, scorer,
+                                     param, value, cv)
+            for value in param_range
+        }
+        missing = [v for v in param_range if keys[v] not in store]
+    else:
+        missing = list(param_range)
+    logger.info(f"Fitting {len(missing)} of {len(param_range)} {param} "
+                f"values with n_jobs={n_jobs}")
+
+    scores = {}
+    if missing:
+        config = {"backend": backend} if backend is not None else {}
+        with parallel_config(**config):
+            train_scores, test_scores = validation_curve(model,
+                                                         X,
+                                                         y,
+                                                         param_name=param,
+                                                         param_range=missing,
+                                                         cv=cv,
+                                                         scoring=scorer,
+                                                         n_jobs=n_jobs)
+        for value, train, test in zip(missing, train_scores, test_scores):
+            scores[value] = (train, test)
+            if cached is True:
+                store.put(scores[value], key=keys[value])
+    for value in param_range:
+        if value not in scores:
+            scores[value] = store.get(keys[value])
+
+    frames = []
+    for value in param_range:
+        train, test = scores[value]
+        frames.append(
+            pd.DataFrame({
+                param: value,
+                "fold": np.arange(len(train)),
+                "train": train,
+                "test": test,
+            }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def plot_validation_curve(scores: pd.DataFrame,
+                          param: str,
+                          scorer: str,
+                          title: str = None,
+                          ax: plt.Axes = None) -> plt.Axes:
+    """Plots mean and standard deviation of scores from
+    compute_validation_curve
+
+    Args:
+        scores (pd.DataFrame): Output of compute_validation_curve
+        param (str): Name of the varied parameter
+        scorer (str): Scoring name used for the axis label
+        title (str, optional): Plot title. Defaults to None.
+        ax (plt.Axes, optional): Axes to draw on. Defaults to None (current
+            axes).
+
+    Returns:
+        plt.Axes: Axes
+    """
+    ax = ax if ax is not None else plt.gca()
+    summary = scores.groupby(param, sort=True)[["train", "test"]].agg(
+        ["mean", "std"])
+    param_range = summary.index.to_numpy()
     lw = 2
-    plt.semilogx(
-        param_range,
-        train_scores_mean,
-        label=f"Training {scorer}",
-        color="darkorange",
-        lw=lw,
-    )
-    plt.fill_between(
-        param_range,
-        train_scores_mean - train_scores_std,
-        train_scores_mean + train_scores_std,
-        alpha=0.2,
-        color="darkorange",
-        lw=lw,
-    )
-    plt.semilogx(
-        param_range,
-        test_scores_mean,
-        label=f"Cross-validation {scorer}",
-        color="navy",
-        lw=lw,
-    )
-    plt.fill_between(
-        param_range,
-        test_scores_mean - test_scores_std,
-        test_scores_mean + test_scores_std,
-        alpha=0.2,
-        color="navy",
-        lw=lw,
-    )
-    plt.legend(loc="best")
+    for split, label, color in [("train", "Training", "darkorange"),
+                                ("test", "Cross-validation", "navy")]:
+        mean = summary[(split, "mean")]
+        std = summary[(split, "std")]
+        ax.semilogx(param_range,
+                    mean,
+                    label=f"{label} {scorer}",
+                    color=color,
+                    lw=lw)
+        ax.fill_between(param_range,
+                        mean - std,
+                        mean + std,
+                        alpha=0.2,
+                        color=color,
+                        lw=lw)
+    ax.set_title(title or f"Validation Curve\n{param}")
+    ax.set_xlabel(param)
+    ax.set_ylabel(scorer)
+    ax.legend(loc="best")
+    return ax
+
+
+def plot_validation_score(model: object,
+                          X: pd.DataFrame,
+                          y: pd.Series,
+                          scorer: str,
+                          param: str,
+                          param_range: list,
+                          **kwargs) -> pd.DataFrame:
+    """Computes and plots a validation curve
+
+    Args:
+        model (object): scikit-learn estimator
+        X (pd.DataFrame): Feature dataset
+        y (pd.Series): labels
+        scorer (str): scikit-learn scoring name
+        param (str): Name of the parameter to vary
+        param_range (list): Parameter values
+        **kwargs: Passed to compute_validation_curve (cv, n_jobs, backend,
+            store, cached)
+
+    Returns:
+        pd.DataFrame: Scores from compute_validation_curve
+    """
+    scores = compute_validation_curve(model, X, y, scorer, param,
+                                      param_range, **kwargs)
+    plot_validation_curve(scores,
+                          param,
+                          scorer,
+                          title=f"Validation Curve\n{model}\n{param}")
     plt.show()
+    return scores
 
 
-def plot_roc_det_curves(X: pd.DataFrame, y: pd.Series, classifiers: dict):
-    """Plots ROC & DET curves
+def classifier_scores(clf: object, X: pd.DataFrame) -> np.ndarray:
+    """Positive class scores from predict_proba or decision_function
 
     Args:
+        clf (object): Fitted binary classifier
         X (pd.DataFrame): Feature dataset
-        y (pd.Series): labels
-        classifiers (dict): {Classifier name: classifier}
+
+    Returns:
+        np.ndarray: Score per row, higher meaning more likely positive
+    """
+    if hasattr(clf, "predict_proba"):
+        return clf.predict_proba(X)[:, 1]
+    return clf.decision_function(X)
+
+
+def roc_det_points(y_true: np.ndarray, scores: np.ndarray) -> pd.DataFrame:
+    """ROC and DET curve points from a single sort of the scores
+
+    Args:
+        y_true (np.ndarray): True labels as bool (positive class is True)
+        scores (np.ndarray): Positive class scores
+
+    Returns:
+        pd.DataFrame: One row per distinct threshold, from highest to
+            lowest, with columns "threshold", "fpr", "tpr" and "fnr"
     """
-    X_train, X_test, y_train, y_test = train_test_split(X,
-                                                        y,
-                                                        test_size=0.3,
-                                                        random_state=0)
+    y_true = np.asarray(y_true, dtype=bool)
+    scores = np.asarray(scores)
+    order = np.argsort(-scores, kind="mergesort")
+    scores = scores[order]
+    # Last row of each run of tied scores
+    distinct = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    tps = np.cumsum(y_true[order])[distinct]
+    fps = distinct + 1 - tps
+    tpr = np.r_[0, tps / max(tps[-1], 1)]
+    fpr = np.r_[0, fps / max(fps[-1], 1)]
+    return pd.DataFrame({
+        "threshold": np.r_[np.inf, scores[distinct]],
+        "fpr": fpr,
+        "tpr": tpr,
+        "fnr": 1 - tpr,
+    })
+
+
+def _fit_and_score(clf: object, X_train: pd.DataFrame, y_train: pd.Series,
+                   X_test: pd.DataFrame) -> tuple:
+    # Runs in a worker process
+    clf.fit(X_train, y_train)
+    return clf, classifier_scores(clf, X_test)
+
+
+def compare_classifiers(X: pd.DataFrame,
+                        y: pd.Series,
+                        classifiers: dict,
+                        test_size: float = 0.3,
+                        random_state: int = 0,
+                        max_workers: int = None) -> tuple:
+    """Fits binary classifiers concurrently and computes their ROC and DET
+    curves on a shared train/test split
+
+    Each classifier is fitted in its own process and scored once on the test
+    set, so comparing models takes about as long as the slowest fit.
 
-    # prepare plots
-    fig, [ax_roc, ax_det] = plt.subplots(1, 2, figsize=(11, 5))
+    Args:
+        X (pd.DataFrame): Feature dataset
+        y (pd.Series): labels
+        classifiers (dict): {Classifier name: classifier}
+        test_size (float, optional): Test set fraction. Defaults to 0.3.
+        random_state (int, optional): Split seed. Defaults to 0.
+        max_workers (int, optional): Processes. Defaults to None (one per
+            classifier, up to the number of CPUs).
 
-    for name, clf in classifiers.items():
-        clf.fit(X_train, y_train)
+    Returns:
+        tuple: ({name: fitted classifier}, {name: roc_det_points frame})
+    """
+    from sklearn.model_selection import train_test_split
+
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=test_size, random_state=random_state)
+    if max_workers is None:
+        max_workers = min(len(classifiers), os.cpu_count() or 1)
+    models = {}
+    curves = {}
+    with ProcessPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        futures = {
+            executor.submit(_fit_and_score, clf, X_train, y_train, X_test):
+            name
+            for name, clf in classifiers.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            clf, scores = future.result()
+            logger.info(f"Fitted {name}")
+            models[name] = clf
+            curves[name] = roc_det_points(y_test == clf.classes_[1], scores)
+    # Keep the caller's order
+    models = {name: models[name] for name in classifiers}
+    curves = {name: curves[name] for name in classifiers}
+    return models, curves
+
+
+def plot_classifier_curves(curves: dict, axes: tuple = None) -> tuple:
+    """Plots ROC and DET curves from compare_classifiers
 
-        plot_roc_curve(clf, X_test, y_test, ax=ax_roc, name=name)
-        plot_det_curve(clf, X_test, y_test, ax=ax_det, name=name)
+    Args:
+        curves (dict): {Classifier name: roc_det_points frame}
+        axes (tuple, optional): (ROC axes, DET axes). Defaults to None (new
+            figure).
 
+    Returns:
+        tuple: (ROC axes, DET axes)
+    """
+    from scipy.stats import norm
+    from sklearn.metrics import auc
+
+    if axes is None:
+        _, axes = plt.subplots(1, 2, figsize=(11, 5))
+    ax_roc, ax_det = axes
+    for name, curve in curves.items():
+        roc_auc = auc(curve["fpr"], curve["tpr"])
+        ax_roc.plot(curve["fpr"],
+                    curve["tpr"],
+                    label=f"{name} (AUC = {roc_auc:.2f})")
+        # DET axes are on a normal deviate scale, where 0 and 1 are infinite
+        det = curve[(curve["fpr"].between(0, 1, inclusive="neither")) &
+                    (curve["fnr"].between(0, 1, inclusive="neither"))]
+        ax_det.plot(norm.ppf(det["fpr"]), norm.ppf(det["fnr"]), label=name)
+
+    ticks = [0.001, 0.01, 0.05, 0.20, 0.5, 0.80, 0.95, 0.99, 0.999]
+    tick_locations = norm.ppf(ticks)
+    tick_labels = [f"{t:.0%}" if (100 * t).is_integer() else f"{t:.1%}"
+                   for t in ticks]
+    ax_det.set_xticks(tick_locations, tick_labels)
+    ax_det.set_yticks(tick_locations, tick_labels)
+    ax_det.set_xlim(-3, 3)
+    ax_det.set_ylim(-3, 3)
+
+    ax_roc.set_xlabel("False Positive Rate")
+    ax_roc.set_ylabel("True Positive Rate")
+    ax_det.set_xlabel("False Positive Rate")
+    ax_det.set_ylabel("False Negative Rate")
     ax_roc.set_title("Receiver Operating Characteristic (ROC) curves")
     ax_det.set_title("Detection Error Tradeoff (DET) curves")
 
     ax_roc.grid(linestyle="--")
     ax_det.grid(linestyle="--")
+    ax_roc.legend(loc="lower right")
+    ax_det.legend(loc="upper right")
+    return ax_roc, ax_det
 
-    plt.legend()
+
+def plot_roc_det_curves(X: pd.DataFrame, y: pd.Series, classifiers: dict,
+                        **kwargs) -> tuple:
+    """Plots ROC & DET curves
+
+    Args:
+        X (pd.DataFrame): Feature dataset
+        y (pd.Series): labels
+        classifiers (dict): {Classifier name: classifier}
+        **kwargs: Passed to compare_classifiers (test_size, random_state,
+            max_workers)
+
+    Returns:
+        tuple: ({name: fitted classifier}, {name: roc_det_points frame})
+    """
+    models, curves = compare_classifiers(X, y, classifiers, **kwargs)
+    plot_classifier_curves(curves)
     plt.show()
+    return models, curves
 
 
 def pickle_for_later(file_path: Path, object: object) -> None:
     """Pickles an object to specified file
 
+    Deprecated: use ArtifactStore().put, which writes large arrays and
+    frames out-of-band so they are memory-mapped on load.
+
     Args:
         file_path (Path): Path to save pickle
         object (object): Any object
     """
+    _deprecated("pickle_for_later", "ArtifactStore().put(obj)")
     if not file_path.suffix == ".pkl":
         file_path = Path(str(file_path) + ".pkl")
     logger.info(f"Pickeling {file_path}")
@@ -134,13 +409,24 @@ def pickle_for_later(file_path: Path, object: object) -> None:
 
 
 def load_pickle(pickle_path: IO) -> Any:
+    """Loads a pickle written by pickle_for_later
 
+    Deprecated: use ArtifactStore().get.
+    """
+    _deprecated("load_pickle", "ArtifactStore().get(key)")
     with open(pickle_path, "rb") as file:
         item = pickle.load(file)
     logger.info(f"{pickle_path.name} loaded")
     return item
 
 
+def _deprecated(name: str, replacement: str) -> None:
+    message = f"{name} is deprecated, use {replacement} (src.artifacts)"
+    # src.loggers hides DeprecationWarning, so also log it
+    logger.warning(message)
+    warnings.warn(message, DeprecationWarning, stacklevel=3)
+
+
 def update_legend(g: sns.FacetGrid,
                   title: str = None,
                   labels: list = None,
@@ -173,24 +459,38 @@ def update_legend(g: sns.FacetGrid,
             t.set_text(l)
 
 
-def quality_control(df: pd.DataFrame, subset: list = None) -> None:
-    """Produces logger.info messages for troubleshooting DataFrame values.
+def quality_control(df: pd.DataFrame,
+                    subset: list = None,
+                    sample=None,
+                    show: bool = True) -> QualityReport:
+    """Builds and displays a quality control report for a DataFrame.
+
+    Statistics are computed in one streaming pass with mergeable sketches
+    (see src.qc), so large frames do not need a full describe/duplicated.
 
     Args:
         df (pd.DataFrame): A pandas DataFrame
-        subset (list, optional): Columns passed to df.duplicated.
+        subset (list, optional): Columns that identify duplicate rows.
                                 Defaults to None.
+        sample (float or int, optional): Fraction or number of rows used for
+                                column statistics. Duplicates are always
+                                checked on every row. Defaults to None.
+        show (bool, optional): Display the report. Defaults to True.
+
+    Returns:
+        QualityReport: Structured report
     """
-    display("Sample data:")
-    display(df.head())
-    display("df.info:")
-    display(df.info(show_counts=True, verbose=True))
-    # display("Count of missing data by column:")
-    # display(df.isna().sum())
-    display("df.describe:")
-    display(df.describe(include='all', datetime_is_numeric=True))
-    display(f"Count of duplicate rows using subset={subset}:")
-    display(df.duplicated(subset=subset, keep='first').sum())
+    from IPython.display import display
+
+    report = build_quality_report(df, subset=subset, sample=sample)
+    if show is True:
+        display("Sample data:")
+        display(df.head())
+        display("Column statistics:")
+        display(report.to_frame())
+        display(f"Count of duplicate rows using subset={subset}:")
+        display(report.duplicates)
+    return report
 
 
 def run_script(script, stdin=None):
@@ -216,10 +516,13 @@ def wait_for_file(file_path: Path,
     """
     Pauses application until a specified file exists or a time limit is reached.
 
+    Wakes as soon as the file appears when inotify is available (see
+    src.watch.wait_for_files for many files, stable sizes and renames).
+
     Args:
         file_path (Path): Path to check for existence
         time_to_wait (int, optional): Time in seconds to wait before checking
-            again. Defaults to 5.
+            again when inotify is unavailable. Defaults to 5.
         time_limit (int, optional): Time in seconds to continue checking.
         Defaults to 200.
 
@@ -227,82 +530,259 @@ def wait_for_file(file_path: Path,
         FileExistsError: File does not exist
     """
     logger.info(f"Waiting for {file_path}")
-    counter = 0
-    while (not file_path.exists) and (counter < time_limit):
-        time.sleep(time_to_wait)
-        counter += time_to_wait
-        if counter == time_limit:
-            print("Time limit reached. Aborting")
-            break
-    if file_path.exists:
-        logger.info(f"{file_path} exists.")
-    else:
-        raise FileExistsError
+    try:
+        wait_for_files([file_path],
+                       timeout=time_limit,
+                       poll_interval=time_to_wait)
+    except TimeoutError:
+        print("Time limit reached. Aborting")
+        raise FileExistsError(f"{file_path} does not exist")
+    logger.info(f"{file_path} exists.")
 
 
 def convert_py_to_html(script_name: str,
                        output_name: str = None,
-                       output_path: Path = None) -> IO:
+                       output_path: Path = None,
+                       pool: KernelPool = None) -> int:
+    """Converts a .py script to a notebook, executes it and exports html
 
-    if output_path is None:
-        output_path = Path(script_name).resolve()
+    The notebook runs in-process on a warm kernel from a KernelPool (see
+    src.notebooks) and its outputs are logged as they arrive.
 
-    if output_name is None:
-        output_name_stem = Path(script_name).stem
+    Args:
+        script_name (str): Script path relative to PROJECT_ROOT. The .py
+            extension is optional.
+        output_name (str, optional): Name of output files (no extension).
+            Defaults to None (script name).
+        output_path (Path, optional): Output directory. Defaults to None
+            (the script's directory).
+        pool (KernelPool, optional): Kernels. Defaults to None (the shared
+            pool).
+
+    Returns:
+        int: 0 on success, 1 if the notebook failed
+    """
+    from jupyter_client.kernelspec import NoSuchKernel
+    from nbclient.exceptions import CellExecutionError, DeadKernelError
 
-    logger.debug(f"output_path : {output_path}")
-    logger.debug(f"output_name_stem : {output_name_stem}")
+    from src.notebooks import render_script
 
-    notebook_ipynb = Path(output_path, Path(str(output_name_stem) + ".ipynb"))
     if Path(script_name).suffix == "":
         script_name = script_name + ".py"
+    script = Path(os.getenv('PROJECT_ROOT'), script_name)
 
-    logger.debug("deleting old notebook")
+    logger.info(f"Executing {script_name} and converting to .html")
     try:
-        os.remove(notebook_ipynb)
-        logger.debug(f"deleted {notebook_ipynb}")
-    except FileNotFoundError:
-        logger.debug(f"{notebook_ipynb} does not exist. Moving on.")
-
-    logger.info("Converting .py to .ipynb")
-    nb = jupytext.read(open(Path(os.getenv('PROJECT_ROOT'), script_name), 'r'))
-    jupytext.write(nb, open(notebook_ipynb, 'w'), fmt='ipynb')
-
-    logger.info("Executing and converting notebook to .html")
-    cmd = f"{os.getenv('PROJECT_ROOT')}/.venv/bin/jupyter nbconvert {notebook_ipynb} --to html --execute --template classic"  # noqa ES01
-    logger.debug("get_ipython(): Got IPython")
-    logger.debug(f"cmd: {cmd}")
-    process = subprocess.run(shlex.split(cmd),
-                             stdout=subprocess.PIPE,
-                             text=True)
-
-    while True:
-        output = process.stdout
-        # print(output.strip())
-        # Do something else
-        return_code = process.returncode
-        if return_code is not None:
-            logger.debug(f'RETURN CODE : {return_code}')
-            # Process has finished, read rest of the output
-            for output in process.stdout:
-                print(output.strip())
-
-            if Path(output_path,
-                    Path(str(output_name_stem) + ".html")).exists():
-                print(
-                    f"Converted {notebook_ipynb} to html: {datetime.now().replace(second=0, microsecond=0)}"  # noqa E501
-                )
-            break
+        html = render_script(script, output_path, output_name, pool=pool)
+    except CellExecutionError as e:
+        logger.error(f"Executing {script_name} failed:\n{e}")
+        return 1
+    except (DeadKernelError, NoSuchKernel, RuntimeError, TimeoutError) as e:
+        logger.error(f"Kernel failed running {script_name}: {e}")
+        return 1
+    print(f"Converted {script_name} to {html}: "
+          f"{datetime.now().replace(second=0, microsecond=0)}")
+    return 0
+
+
+def _init_render_worker() -> None:
+    # Warm the worker's kernels while the first notebook is queued. Pool
+    # workers skip atexit, so shut the kernels down with a finalizer.
+    from src.notebooks import get_kernel_pool
+
+    pool = get_kernel_pool()
+    threading.Thread(target=_warm_kernels, args=(pool, ), daemon=True).start()
+    Finalize(pool, pool.shutdown, exitpriority=10)
+
+
+def _warm_kernels(pool: KernelPool) -> None:
+    try:
+        pool.start()
+    except Exception:
+        # Already logged by start(). The render retries the kernel and
+        # reports the notebook as failed if it cannot start.
+        pass
+
+
+def _render_notebook(script_name: str, output_name: str,
+                     output_path: Path) -> tuple:
+    # Runs in a worker process
+    start = time.perf_counter()
+    returncode = convert_py_to_html(script_name, output_name, output_path)
+    return returncode, time.perf_counter() - start
+
+
+def _render_hash(script: Path, inputs: list) -> str:
+    # Script content plus the size and mtime of each input file
+    with open(script, "rb") as f:
+        source = hashlib.sha256(f.read()).hexdigest()
+    stats = []
+    for p in inputs:
+        st = p.stat()
+        stats.append([str(p), st.st_size, st.st_mtime_ns])
+    return spec_hash(source, stats)
+
+
+def _expand_globs(patterns: list) -> list:
+    root = Path(os.getenv('PROJECT_ROOT'))
+    paths = []
+    for pattern in patterns or []:
+        paths += sorted(p.relative_to(root) for p in root.glob(pattern))
+    return paths
+
+
+def render_notebooks(scripts: list,
+                     output_name: str = None,
+                     output_path: Path = None,
+                     inputs: list = None,
+                     max_workers: int = None,
+                     force: bool = False) -> pd.DataFrame:
+    """Renders many scripts to html with a bounded process pool
+
+    A script is skipped when its content and the listed input files are
+    unchanged since its last successful render and its html still exists.
+    Successful renders are recorded in a .render_manifest.json in each
+    output directory.
+
+    Args:
+        scripts (list): Script paths relative to PROJECT_ROOT
+        output_name (str, optional): Name of output files. Only valid with
+            one script. Defaults to None (script name).
+        output_path (Path, optional): Output directory. Defaults to None
+            (each script's directory).
+        inputs (list, optional): Globs of input files (relative to
+            PROJECT_ROOT) the scripts read. A changed input re-renders every
+            script. Defaults to None.
+        max_workers (int, optional): Notebooks rendered concurrently, at
+            most one per script to render. Defaults to None (number of
+            CPUs).
+        force (bool, optional): Render unchanged scripts. Defaults to False.
+
+    Raises:
+        ValueError: output_name is given for more than one script
+
+    Returns:
+        pd.DataFrame: script, status ("rendered", "skipped" or "failed"),
+            returncode and seconds per script
+    """
+    if (output_name is not None) & (len(scripts) > 1):
+        raise ValueError("output_name can only be used with one script")
+    root = Path(os.getenv('PROJECT_ROOT'))
+    input_paths = _expand_globs(inputs)
+    results = {}
+    pending = {}
+    order = []
+    for script_name in map(str, scripts):
+        if Path(script_name).suffix == "":
+            script_name = script_name + ".py"
+        if script_name in order:
+            continue
+        order.append(script_name)
+        script = Path(root, script_name)
+        out_dir = Path(output_path or script.parent)
+        name = output_name or script.stem
+        manifest = CacheManifest(Path(out_dir, ".render_manifest.json"))
+        try:
+            render_hash = _render_hash(script,
+                                       [root / p for p in input_paths])
+        except FileNotFoundError as e:
+            logger.error(f"Cannot render {script_name}: {e}")
+            results[script_name] = ("failed", 1, 0.0)
+            continue
+        if (force is False) & Path(out_dir, f"{name}.html").exists() & \
+                manifest.is_fresh(script_name, render_hash):
+            logger.info(f"{script_name} is unchanged. Skipping")
+            results[script_name] = ("skipped", None, 0.0)
+            continue
+        pending[script_name] = (name, out_dir, manifest, render_hash)
+
+    # Each worker starts its own kernels, so never start idle workers
+    max_workers = min(max_workers or os.cpu_count(), len(pending))
+    if pending:
+        _render_pending(pending, max_workers, results)
+
+    results = pd.DataFrame.from_dict(
+        {s: results[s] for s in order},
+        orient="index",
+        columns=["status", "returncode", "seconds"]).astype(
+            {"returncode": "Int64"})
+    results.index.name = "script"
+    return results.reset_index()
+
+
+def _render_pending(pending: dict, max_workers: int, results: dict) -> None:
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_render_worker) as executor:
+        futures = {
+            executor.submit(_render_notebook, script_name, name, out_dir):
+            script_name
+            for script_name, (name, out_dir, _, _) in pending.items()
+        }
+        for future in as_completed(futures):
+            script_name = futures[future]
+            results[script_name] = _render_result(script_name, future,
+                                                  *pending[script_name][2:])
+
+
+def _render_result(script_name: str, future, manifest: CacheManifest,
+                   render_hash: str) -> tuple:
+    try:
+        returncode, seconds = future.result()
+    except Exception:
+        logger.exception(f"Rendering {script_name} failed")
+        return "failed", None, None
+    if returncode:
+        logger.error(f"{script_name} failed with return code {returncode} "
+                     f"after {seconds:.1f}s")
+        return "failed", returncode, seconds
+    logger.info(f"Rendered {script_name} in {seconds:.1f}s")
+    manifest.update(script_name, spec_hash=render_hash, seconds=seconds)
+    return "rendered", returncode, seconds
 
 
 @click.command("convert-to-html")
 @click.option('-s',
               '--script-name',
-              help='Name of .py script to convert',
-              required=True)
+              multiple=True,
+              help='Name of .py script to convert. Repeat for a batch')
+@click.option('-g',
+              '--glob',
+              'patterns',
+              multiple=True,
+              help='Glob of scripts relative to PROJECT_ROOT, '
+              'e.g. "notebooks/*.py"')
 @click.option('-on',
               '--output-name',
               help='Name of output files (no extension)')
 @click.option('-op', '--output-path', help='Path to output destination')
-def convert_py_to_html_command(script_name, output_name, output_path):
-    convert_py_to_html(script_name, output_name, output_path)
+@click.option('-i',
+              '--input',
+              'inputs',
+              multiple=True,
+              help='Glob of input files the scripts read. '
+              'Changed inputs re-render')
+@click.option('-j',
+              '--jobs',
+              type=int,
+              help='Notebooks rendered concurrently. Defaults to CPUs')
+@click.option('-f',
+              '--force',
+              is_flag=True,
+              help='Render scripts even when unchanged')
+def convert_py_to_html_command(script_name, patterns, output_name,
+                               output_path, inputs, jobs, force):
+    scripts = list(script_name) + _expand_globs(patterns)
+    if not scripts:
+        raise click.UsageError("Provide --script-name or --glob")
+    try:
+        results = render_notebooks(scripts,
+                                   output_name=output_name,
+                                   output_path=output_path,
+                                   inputs=inputs,
+                                   max_workers=jobs,
+                                   force=force)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    click.echo(results.to_string(index=False))
+    if (results["status"] == "failed").any():
+        sys.exit(1)
@@ -0,0 +1,265 @@
+"""Waits for files to become ready, woken by inotify instead of sleeping.
+
+On Linux the parent directories of the awaited files are watched with
+inotify (through ctypes), so a waiter wakes as soon as a file is created,
+written or renamed into place. Elsewhere, or when a parent directory does
+not exist yet, the files are polled.
+
+A file is ready when it exists and, optionally,
+    * it was renamed into place (e.g. written to a temporary file and then
+      moved atomically), or
+    * its size and modification time have not changed for some seconds.
+"""
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify wrapper that watches directories
+
+    Raises:
+        OSError: inotify is not available
+    """
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._dirs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_watch(self, directory: Path, mask: int = WATCH_MASK) -> None:
+        wd = self._libc.inotify_add_watch(self.fd,
+                                          os.fsencode(directory), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(directory))
+        self._dirs[wd] = Path(directory)
+
+    def wait(self, timeout: float) -> bool:
+        """Blocks until events are available or timeout seconds pass"""
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        return bool(readable)
+
+    def read(self) -> list:
+        """Pending events as (path, mask) without blocking"""
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                offset += _EVENT.size
+                name = buffer[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                elif wd in self._dirs:
+                    path = Path(self._dirs[wd], os.fsdecode(name))
+                    events.append((path, mask))
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _open_watcher(paths: list, use_inotify: bool):
+    # Inotify on the parent directories, or a null context to poll
+    if use_inotify is False:
+        return contextlib.nullcontext()
+    try:
+        watcher = Inotify()
+    except OSError as e:
+        logger.debug(f"Polling: {e}")
+        return contextlib.nullcontext()
+    try:
+        for directory in {p.parent for p in paths}:
+            watcher.add_watch(directory)
+    except OSError as e:
+        logger.debug(f"Polling: {e}")
+        watcher.close()
+        return contextlib.nullcontext()
+    return watcher
+
+
+class _FileState:
+    """Readiness of one awaited file"""
+    def __init__(self, path: Path, stable_for: float, require_rename: bool):
+        self.path = path
+        self.stable_for = stable_for
+        # A file that is already there was renamed into place (or written
+        # before the wait started)
+        self.renamed = (not require_rename) or path.exists()
+        self.stat = None
+        self.since = None
+
+    def ready(self, now: float) -> bool:
+        if not self.renamed:
+            return False
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            self.stat = None
+            return False
+        if not self.stable_for:
+            return True
+        stat = (st.st_size, st.st_mtime_ns)
+        if stat != self.stat:
+            self.stat, self.since = stat, now
+        return now - self.since >= self.stable_for
+
+    def next_check(self) -> float:
+        if self.stat is None or not self.stable_for:
+            return float("inf")
+        return self.since + self.stable_for
+
+
+def _apply_events(pending: dict, events: list) -> None:
+    for path, mask in events:
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, so trust files that exist
+            for state in pending.values():
+                state.renamed = state.renamed or state.path.exists()
+        elif mask & IN_MOVED_TO and path in pending:
+            pending[path].renamed = True
+
+
+def _wait_steps(paths: list, watcher, timeout: float, stable_for: float,
+                require_rename: bool, poll_interval: float):
+    """Checks the files and yields how long to wait before checking again
+
+    Raises:
+        TimeoutError: Files were not ready within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    pending = {
+        p: _FileState(p, stable_for, require_rename and watcher is not None)
+        for p in paths
+    }
+    while True:
+        if watcher is not None:
+            _apply_events(pending, watcher.read())
+        now = time.monotonic()
+        for path in [p for p, state in pending.items() if state.ready(now)]:
+            logger.debug(f"{path} is ready")
+            del pending[path]
+        if not pending:
+            return
+        if now >= deadline:
+            raise TimeoutError(
+                f"Timed out after {timeout}s waiting for {list(pending)}")
+        wake = min([deadline] + [s.next_check() for s in pending.values()])
+        if watcher is None:
+            wake = min(wake, now + poll_interval)
+        yield wake - now
+
+
+def wait_for_files(paths: list,
+                   timeout: float = 200,
+                   stable_for: float = None,
+                   require_rename: bool = False,
+                   poll_interval: float = 1.0,
+                   use_inotify: bool = True) -> list:
+    """Blocks until every file is ready
+
+    Args:
+        paths (list): Paths to wait for
+        timeout (float, optional): Seconds to wait. Defaults to 200.
+        stable_for (float, optional): Also require each file's size and
+            modification time to be unchanged for this many seconds.
+            Defaults to None.
+        require_rename (bool, optional): Only accept files that already
+            exist or are renamed into place, not files being written in
+            place. Ignored when polling. Defaults to False.
+        poll_interval (float, optional): Seconds between checks when
+            inotify is unavailable. Defaults to 1.0.
+        use_inotify (bool, optional): Use inotify when available.
+            Defaults to True.
+
+    Raises:
+        TimeoutError: Files were not ready within timeout seconds
+
+    Returns:
+        list: Paths
+    """
+    paths = [Path(p).absolute() for p in paths]
+    logger.info(f"Waiting for {len(paths)} files")
+    with _open_watcher(paths, use_inotify) as watcher:
+        for wait in _wait_steps(paths, watcher, timeout, stable_for,
+                                require_rename, poll_interval):
+            if watcher is None:
+                time.sleep(wait)
+            else:
+                watcher.wait(wait)
+    return paths
+
+
+async def wait_for_files_async(paths: list,
+                               timeout: float = 200,
+                               stable_for: float = None,
+                               require_rename: bool = False,
+                               poll_interval: float = 1.0,
+                               use_inotify: bool = True) -> list:
+    """asyncio version of wait_for_files
+
+    The inotify descriptor is watched by the event loop, so other tasks run
+    while waiting. Arguments are the same as wait_for_files.
+
+    Raises:
+        TimeoutError: Files were not ready within timeout seconds
+
+    Returns:
+        list: Paths
+    """
+    paths = [Path(p).absolute() for p in paths]
+    loop = asyncio.get_running_loop()
+    with _open_watcher(paths, use_inotify) as watcher:
+        for wait in _wait_steps(paths, watcher, timeout, stable_for,
+                                require_rename, poll_interval):
+            if watcher is None:
+                await asyncio.sleep(wait)
+                continue
+            readable = asyncio.Event()
+            loop.add_reader(watcher.fd, readable.set)
+            try:
+                await asyncio.wait_for(readable.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_reader(watcher.fd)
+    return paths
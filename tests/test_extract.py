@@ -0,0 +1,130 @@
+"""COPY extract and load against a stand-in psycopg2 connection.
+
+The stand-in implements only the cursor calls src.extract and src.load use
+(mogrify, execute, description and copy_expert), so these run without a
+PostgreSQL server.
+"""
+import io
+
+import pandas as pd
+import psycopg2
+import pytest
+from sqlalchemy.dialects.postgresql import psycopg2 as pg
+
+from src.extract import copy_extract, read_copy_csv, read_query
+from src.load import copy_frame
+from src.sql import build_select
+
+
+class StandInCursor:
+    def __init__(self, server: "StandInConnection"):
+        self.server = server
+        self.description = None
+
+    def mogrify(self, sql, params):
+        literals = {
+            k: f"'{v}'" if isinstance(v, str) else str(v)
+            for k, v in params.items()
+        }
+        return (sql % literals).encode()
+
+    def execute(self, sql):
+        self.server.queries.append(sql)
+        self.description = [(name, oid, None, None, None, None, None)
+                            for name, oid in self.server.columns]
+
+    def copy_expert(self, sql, f):
+        self.server.queries.append(sql)
+        if "TO STDOUT" in sql:
+            f.write(self.server.csv)
+        else:
+            self.server.copied.append(f.read())
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    """Serves a fixed CSV result for every COPY ... TO STDOUT"""
+    def __init__(self, columns: list = (), csv: bytes = b""):
+        self.dialect = pg.dialect(dbapi=psycopg2)
+        self.columns = list(columns)
+        self.csv = csv
+        self.queries = []
+        self.copied = []
+        self.rolled_back = False
+        self.connection = self
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+COLUMNS = [("id", 23), ("name", 25), ("flag", 16), ("at", 1114)]
+CSV = (b'id,name,flag,at\n'
+       b'1,"a",t,2020-01-01 00:00:00\n'
+       b'2,"",f,\n'
+       b'3,,t,2020-01-03 12:30:00\n')
+
+
+@pytest.fixture
+def stmt():
+    return build_select("t",
+                        columns={c: c for c, _ in COLUMNS},
+                        where={"id": [1, 2, 3]})
+
+
+def test_copy_extract_types_columns_from_result_types(stmt):
+    con = StandInConnection(COLUMNS, CSV)
+    df = copy_extract(stmt, con)
+    assert con.queries[-1].startswith("COPY (SELECT")
+    assert "IN (1, 2, 3)" in con.queries[-1]
+    assert df["id"].dtype == "int32"
+    assert pd.api.types.is_string_dtype(df["name"])
+    assert df["flag"].tolist() == [True, False, True]
+    assert df["at"].dtype == "datetime64[us]"
+    # Unquoted empty fields are NULL, quoted ones are empty strings
+    assert df["name"].isna().tolist() == [False, False, True]
+    assert df["name"].iloc[1] == ""
+    assert df["at"].isna().tolist() == [False, True, False]
+
+
+def test_copy_extract_chunks(stmt):
+    con = StandInConnection(COLUMNS, CSV)
+    chunks = list(copy_extract(stmt, con, chunksize=2))
+    assert [len(c) for c in chunks] == [2, 1]
+    assert pd.concat(chunks)["id"].tolist() == [1, 2, 3]
+
+
+def test_read_copy_csv_yields_one_empty_frame():
+    chunks = list(read_copy_csv(io.BytesIO(b"id,name\n"), chunksize=2))
+    assert [len(c) for c in chunks] == [0]
+    assert chunks[0].columns.tolist() == ["id", "name"]
+
+
+@pytest.mark.parametrize("chunksize", [None, 2])
+def test_read_query_falls_back_on_unparsable_values(stmt, monkeypatch,
+                                                    chunksize):
+    # Arrow cannot parse PostgreSQL's infinite timestamps
+    con = StandInConnection(COLUMNS, CSV.replace(b"2020-01-01 00:00:00",
+                                                 b"infinity"))
+    fallback = pd.DataFrame({"id": [1, 2, 3]})
+    monkeypatch.setattr(pd, "read_sql",
+                        lambda stmt, con, chunksize: fallback)
+    assert read_query(stmt, con, chunksize=chunksize) is fallback
+    assert con.rolled_back is True
+
+
+def test_copy_frame_writes_nulls_unquoted():
+    con = StandInConnection()
+    df = pd.DataFrame({
+        "id": [1, 2, 3],
+        "name": ["a", "", None],
+        "group": pd.Categorical(["x", "y", "x"]),
+    })
+    copy_frame(df, "t", con, schema="s", batch_size=2)
+    assert con.queries[0] == ('COPY s.t (id, name, "group") FROM STDIN '
+                              'WITH (FORMAT csv)')
+    assert con.copied == [b'1,"a","x"\n2,"","y"\n', b'3,,"x"\n']